@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# Load-generation benchmarks for shotlib.wsgiserver, shotlib.asyncwsgi and
+# shotlib.fastcgi.
+#
+# Each scenario forks a server on localhost running one of the synthetic
+# WSGI apps below, drives it with several client processes for a fixed
+# time and reports requests per second and p50/p99 latency.  Run it before
+# and after a server change, on an otherwise idle machine:
+#
+#   python benchmarks/httpbench.py
+#   python benchmarks/httpbench.py --server wsgi --scenario tiny-keepalive \
+#       --clients 16 --duration 10
+#
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+from struct import unpack
+from optparse import OptionParser
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from shotlib import wsgiserver
+from shotlib import asyncwsgi
+from shotlib import fastcgi
+
+#
+# The apps
+#
+
+TINY_BODY = '{"status": "ok", "items": [1, 2, 3]}'
+LARGE_CHUNK = 'x' * 65536
+LARGE_CHUNKS = 16
+SLOW_DELAY = 0.01
+
+def tiny_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(TINY_BODY)))])
+    return [TINY_BODY]
+
+def large_app(environ, start_response):
+    # No Content-Length, so HTTP/1.1 responses are chunked.
+    start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    def body():
+        for i in xrange(LARGE_CHUNKS):
+            yield LARGE_CHUNK
+    return body()
+
+def slow_app(environ, start_response):
+    time.sleep(SLOW_DELAY)
+    return tiny_app(environ, start_response)
+
+APPS = {'tiny': tiny_app,
+        'large': large_app,
+        'slow': slow_app}
+
+# (name, app, keep-alive, requests pipelined per round trip)
+SCENARIOS = [('tiny-keepalive', 'tiny', True, 1),
+             ('tiny-close', 'tiny', False, 1),
+             ('tiny-pipelined', 'tiny', True, 8),
+             ('large-keepalive', 'large', True, 1),
+             ('slow-keepalive', 'slow', True, 1)]
+
+SERVERS = ['wsgi', 'async', 'fastcgi']
+
+# The protocol the clients speak to each server
+PROTOCOL = {'wsgi': 'http',
+            'async': 'http',
+            'fastcgi': 'fastcgi'}
+
+# Seconds a client waits on a response before counting an error (so a
+# server which doesn't answer fails the run instead of hanging it)
+CLIENT_TIMEOUT = 10.0
+
+#
+# The servers, each run in a forked process on an already listening socket
+#
+
+class ServerStop(Exception):
+    pass
+
+def serve_wsgi(sock, app, options,
+               server_class=wsgiserver.CherryPyWSGIServer):
+    server = server_class(sock.getsockname(), app,
+                          numthreads=options.threads,
+                          server_name='localhost',
+                          use_selector=options.selector)
+    server.socket = sock
+    def stop(signum, frame):
+        server.interrupt = ServerStop()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.start()
+    except ServerStop:
+        pass
+
+def serve_async(sock, app, options):
+    serve_wsgi(sock, app, options, asyncwsgi.AsyncWSGIServer)
+
+def serve_fastcgi(sock, app, options):
+    server = fastcgi.WSGIServer(sock.getsockname(), app,
+                                threads=options.threads)
+    server.socket = sock
+    def stop(signum, frame):
+        raise ServerStop()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.start()
+    except ServerStop:
+        pass
+
+SERVE = {'wsgi': serve_wsgi,
+         'async': serve_async,
+         'fastcgi': serve_fastcgi}
+
+def start_server(kind, app, options):
+    """Fork a server; return (pid, address)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', options.port))
+    sock.listen(1024)
+    address = sock.getsockname()
+    pid = os.fork()
+    if pid:
+        sock.close()
+        return pid, address
+    status = 1
+    try:
+        SERVE[kind](sock, app, options)
+        status = 0
+    finally:
+        os._exit(status)
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGTERM)
+    while True:
+        try:
+            os.waitpid(pid, 0)
+            return
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+#
+# The client
+#
+
+class Reader(object):
+    """Buffered reads from a socket, raising EOFError if it closes."""
+
+    bufsize = 65536
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+
+    def fill(self):
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise EOFError()
+        self.buf += data
+
+    def read(self, size):
+        while len(self.buf) < size:
+            self.fill()
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def until(self, sep):
+        """Read up to (and discard) sep."""
+        while True:
+            i = self.buf.find(sep)
+            if i >= 0:
+                data, self.buf = self.buf[:i], self.buf[i + len(sep):]
+                return data
+            self.fill()
+
+    def skip(self, size):
+        while len(self.buf) < size:
+            size -= len(self.buf)
+            self.buf = ''
+            self.fill()
+        self.buf = self.buf[size:]
+
+    def skip_all(self):
+        try:
+            while True:
+                self.buf = ''
+                self.fill()
+        except EOFError:
+            pass
+
+def http_request(path, keepalive):
+    if keepalive:
+        connection = ''
+    else:
+        connection = 'Connection: close\r\n'
+    return ('GET %s HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'User-Agent: httpbench\r\n'
+            '%s\r\n' % (path, connection))
+
+def read_http_response(reader):
+    """Read one response; return (status, connection closed?)."""
+    lines = reader.until('\r\n\r\n').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    length = None
+    chunked = False
+    close = False
+    for line in lines[1:]:
+        name, value = line.split(':', 1)
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = value == 'chunked'
+        elif name == 'connection':
+            close = value == 'close'
+    if chunked:
+        while True:
+            size = int(reader.until('\r\n').split(';', 1)[0], 16)
+            if not size:
+                # Skip the trailer
+                while reader.until('\r\n'):
+                    pass
+                break
+            reader.skip(size + 2)
+    elif length is not None:
+        reader.skip(length)
+    else:
+        reader.skip_all()
+        close = True
+    return status, close
+
+def fcgi_request(request_id, path, keepalive):
+    flags = 0
+    if keepalive:
+        flags = fastcgi.FCGI_KEEP_CONN
+    begin = fastcgi.BeginRequestBody(role=fastcgi.FCGI_RESPONDER, flags=flags)
+    params = fastcgi.NameValuePairs()
+    for name, value in (('REQUEST_METHOD', 'GET'),
+                        ('SCRIPT_NAME', ''),
+                        ('PATH_INFO', path),
+                        ('QUERY_STRING', ''),
+                        ('SERVER_NAME', 'localhost'),
+                        ('SERVER_PORT', '80'),
+                        ('SERVER_PROTOCOL', 'HTTP/1.1'),
+                        ('REMOTE_ADDR', '127.0.0.1'),
+                        ('HTTP_HOST', 'localhost'),
+                        ('HTTP_USER_AGENT', 'httpbench')):
+        params.add(name, value)
+    pieces = []
+    for type, body in ((fastcgi.FCGI_BEGIN_REQUEST, begin.pack()),
+                       (fastcgi.FCGI_PARAMS, params.unparse()),
+                       (fastcgi.FCGI_PARAMS, ''),
+                       (fastcgi.FCGI_STDIN, '')):
+        pieces.extend(fastcgi.pack_record(type, request_id, body))
+    return ''.join(pieces)
+
+def read_fcgi_response(reader):
+    """Read records up to an FCGI_END_REQUEST; return its request id."""
+    while True:
+        version, type, request_id, length, padding = unpack(
+            '!BBHHBx', reader.read(fastcgi.FCGI_HEADER_LEN))
+        reader.skip(length + padding)
+        if type == fastcgi.FCGI_END_REQUEST:
+            return request_id
+
+def run_client(kind, address, scenario, duration, results):
+    name, app, keepalive, depth = scenario
+    path = '/' + app
+    http = PROTOCOL[kind] == 'http'
+    if http:
+        payload = http_request(path, keepalive) * depth
+    else:
+        payload = ''.join([fcgi_request(i + 1, path, keepalive)
+                           for i in xrange(depth)])
+    latencies = []
+    errors = 0
+    sock = None
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            if sock is None:
+                sock = socket.create_connection(address, CLIENT_TIMEOUT)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reader = Reader(sock)
+            start = time.time()
+            sock.sendall(payload)
+            close = not keepalive
+            for i in xrange(depth):
+                if http:
+                    status, close = read_http_response(reader)
+                    if status != 200:
+                        errors += 1
+                else:
+                    read_fcgi_response(reader)
+                latencies.append(time.time() - start)
+            if close:
+                sock.close()
+                sock = None
+        except (socket.error, EOFError, ValueError):
+            errors += 1
+            if sock is not None:
+                sock.close()
+                sock = None
+    if sock is not None:
+        sock.close()
+    results.put((latencies, errors))
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[int(round((len(ordered) - 1) * p / 100.0))]
+
+def run_scenario(kind, scenario, options):
+    pid, address = start_server(kind, APPS[scenario[1]], options)
+    try:
+        results = Queue()
+        clients = [Process(target=run_client,
+                           args=(kind, address, scenario, options.duration,
+                                 results))
+                   for i in xrange(options.clients)]
+        started = time.time()
+        for client in clients:
+            client.start()
+        latencies = []
+        errors = 0
+        # Collect before join()ing, or a client can block on a full pipe
+        for client in clients:
+            l, e = results.get()
+            latencies.extend(l)
+            errors += e
+        for client in clients:
+            client.join()
+        elapsed = time.time() - started
+    finally:
+        stop_server(pid)
+    latencies.sort()
+    return {'server': kind,
+            'scenario': scenario[0],
+            'requests': len(latencies),
+            'errors': errors,
+            'rate': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50) * 1000,
+            'p99': percentile(latencies, 99) * 1000}
+
+REPORT = ('%(server)-8s %(scenario)-16s %(rate)10.1f req/s'
+          '   p50 %(p50)8.2fms   p99 %(p99)8.2fms'
+          '   %(requests)8d requests %(errors)5d errors')
+
+def option_parser():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--server", action="append", dest="servers",
+                      choices=SERVERS,
+                      help="Server to benchmark: %s (default: all; repeatable)"
+                      % ", ".join(SERVERS))
+    parser.add_option("--scenario", action="append", dest="scenarios",
+                      choices=[s[0] for s in SCENARIOS],
+                      help="Scenario to run: %s (default: all; repeatable)"
+                      % ", ".join([s[0] for s in SCENARIOS]))
+    parser.add_option("-c", "--clients", action="store", type="int",
+                      default=8, help="Client processes (default: 8)")
+    parser.add_option("-t", "--duration", action="store", type="float",
+                      default=5.0,
+                      help="Seconds to run each scenario (default: 5)")
+    parser.add_option("--threads", action="store", type="int", default=10,
+                      help="wsgiserver and fastcgi worker threads "
+                      "(default: 10)")
+    parser.add_option("--selector", action="store_true", default=False,
+                      help="Run wsgiserver with use_selector=True")
+    parser.add_option("-p", "--port", action="store", type="int", default=0,
+                      help="Port to listen on (default: any free port)")
+    return parser
+
+def main(argv=None):
+    options, args = option_parser().parse_args(argv)
+    servers = options.servers or SERVERS
+    scenarios = [s for s in SCENARIOS
+                 if not options.scenarios or s[0] in options.scenarios]
+    for kind in servers:
+        for scenario in scenarios:
+            print REPORT % run_scenario(kind, scenario, options)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
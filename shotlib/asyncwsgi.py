@@ -0,0 +1,744 @@
+#
+# An HTTP server for WSGI which does all of its socket I/O on one asyncore
+# event loop, and uses threads only to run applications.
+#
+# AsyncWSGIServer is a CherryPyWSGIServer -- same options, mount points,
+# request parsing, environ, statistics and admission control -- whose
+# ConnectionSelector is replaced by an EventLoop. Connections are read and
+# written without blocking, request heads are parsed on the loop, and only
+# the application call is handed to the ThreadPool; a slow client never
+# holds a thread. Applications marked @asynchronous hold none at all: they
+# are called on the loop and may answer later, from any thread, through a
+# PendingResponse.
+#
+
+import sys
+import time
+import errno
+import socket
+import asyncore
+import logging
+import heapq
+import threading
+from collections import deque
+
+from shotlib.wsgiserver import CherryPyWSGIServer, HTTPConnection, \
+     SocketReader, WakeupPipe, ChunkedRFile, MaxSizeExceeded, format_exc, \
+     socket_errors_to_ignore
+
+LOG = logging.getLogger('shotlib.asyncwsgi')
+
+def asynchronous(app):
+    """Mark a WSGI app to be called on the event loop instead of a thread.
+
+    The app must not block. It may return its body as usual (it is iterated
+    on the loop, so it should be a list of strings), or return a
+    PendingResponse and call start_response and then finish() later, from
+    any thread. The request body is read in full before the app is called,
+    so reading wsgi.input doesn't block either; chunked request bodies are
+    refused with "411 Length Required".
+    """
+    app.asynchronous = True
+    return app
+
+class PendingResponse(object):
+    """Returned by an @asynchronous app which will answer later.
+
+    finish(body): the response is ready; body is its iterable (after
+        start_response has been called).
+    fail(exc_info): answer with a "500 Internal Server Error" instead
+        (exc_info defaults to the exception being handled).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callback = None
+        self._outcome = None
+        self.done = False
+
+    def _settle(self, outcome):
+        self._lock.acquire()
+        try:
+            if self.done:
+                raise AssertionError("PendingResponse finished twice.")
+            self.done = True
+            self._outcome = outcome
+            callback = self._callback
+        finally:
+            self._lock.release()
+        if callback is not None:
+            callback(outcome)
+
+    def finish(self, body=()):
+        self._settle((body, None))
+
+    def fail(self, exc_info=None):
+        self._settle((None, exc_info or sys.exc_info()))
+
+    def _then(self, callback):
+        self._lock.acquire()
+        try:
+            if not self.done:
+                self._callback = callback
+                return
+        finally:
+            self._lock.release()
+        callback(self._outcome)
+
+
+class AsyncReader(SocketReader):
+    """The read side of an AsyncConnection.
+
+    The EventLoop receives from the socket and feed()s what arrives; a
+    worker thread reading a request body waits (up to timeout seconds) for
+    it instead of calling recv() itself. Between requests, the loop
+    absorb()s what has arrived into the buffer to look for the next head.
+
+    pending: the number of bytes fed but not yet absorbed or read. The loop
+        stops receiving while it is over high_water; on_drain is called
+        (from the reading thread) when a read brings it back under.
+    eof: True once the client has closed its end.
+    """
+
+    def __init__(self, timeout, high_water, on_drain):
+        SocketReader.__init__(self, None)
+        self.timeout = timeout
+        self.high_water = high_water
+        self.on_drain = on_drain
+        self.pending = 0
+        self.eof = False
+        self._inbox = deque()
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        """Add data received from the client ("" for end of file)."""
+        self._cond.acquire()
+        try:
+            if data:
+                self._inbox.append(data)
+                self.pending += len(data)
+            else:
+                self.eof = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def absorb(self):
+        """Move everything fed so far into the buffer.
+
+        Only for the loop, while no worker is reading the connection.
+        """
+        self._cond.acquire()
+        try:
+            data = "".join(self._inbox)
+            self._inbox.clear()
+            self.pending = 0
+        finally:
+            self._cond.release()
+        if data:
+            self._buf += data
+
+    def _recv(self, size):
+        self._cond.acquire()
+        try:
+            deadline = None
+            while not self._inbox:
+                if self.eof or self.closed:
+                    return ""
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                self._cond.wait(remaining)
+            data = self._inbox.popleft()
+            if len(data) > size:
+                self._inbox.appendleft(data[size:])
+                data = data[:size]
+            drained = (self.pending >= self.high_water and
+                       self.pending - len(data) < self.high_water)
+            self.pending -= len(data)
+        finally:
+            self._cond.release()
+        if drained:
+            self.on_drain()
+        return data
+
+    def close(self):
+        self._cond.acquire()
+        try:
+            self.closed = True
+            self._inbox.clear()
+            self.pending = 0
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        SocketReader.close(self)
+
+
+class AsyncConnection(HTTPConnection):
+    """An HTTPConnection whose socket I/O is done by the server's EventLoop.
+
+    sendall and sendv queue output for the loop to write. In a worker
+    thread they wait while more than high_water bytes are queued, so a
+    streaming app can't outrun a slow client; on the loop they never block.
+    close() closes the socket once the queued output has been written.
+
+    request: the request parsed on the loop, for communicate() to answer.
+    busy: True from when a request head is parsed until its response is
+        finished; meanwhile received data is left for the request to read.
+    channel: the asyncore dispatcher watching the socket (on the loop).
+    """
+
+    high_water = 262144
+    coalesce_size = 65536
+    busy = False
+    closing = False
+    request = None
+    channel = None
+    # Body bytes an @asynchronous request is waiting for, or None.
+    awaiting_body = None
+    parse_time = 0.0
+    memory_token = None
+
+    def __init__(self, sock, addr, server):
+        HTTPConnection.__init__(self, sock, addr, server)
+        self.rfile = AsyncReader(server.timeout, self.high_water,
+                                 self._wakeup)
+        self.environ["wsgi.input"] = self.rfile
+        self.sendall = self._queue_one
+        self.sendv = self.queue_output
+        self.can_sendfile = False
+        self.last_active = time.time()
+        self._out = deque()
+        self._out_bytes = 0
+        self._out_cond = threading.Condition()
+
+    def _wakeup(self):
+        loop = self.server.selector
+        if loop is not None:
+            loop.wakeup()
+
+    def _queue_one(self, data):
+        self.queue_output([data])
+
+    def queue_output(self, pieces):
+        """Queue strings to be sent to the client, in order."""
+        loop = self.server.selector
+        self._out_cond.acquire()
+        try:
+            if self.closed:
+                raise socket.error(errno.EPIPE, "Connection closed")
+            for piece in pieces:
+                if piece:
+                    self._out.append(piece)
+                    self._out_bytes += len(piece)
+            if loop is None or loop.in_loop():
+                return
+            loop.wakeup()
+            deadline = None
+            while self._out_bytes > self.high_water and not self.closed:
+                if deadline is None:
+                    deadline = time.time() + self.server.timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                self._out_cond.wait(remaining)
+        finally:
+            self._out_cond.release()
+
+    def has_output(self):
+        return self._out_bytes > 0
+
+    def flush(self):
+        """Send as much queued output as the socket takes; True if all sent.
+
+        Only for the loop.
+        """
+        self._out_cond.acquire()
+        try:
+            out = self._out
+            while out:
+                if len(out) > 1 and len(out[0]) < self.coalesce_size:
+                    # Many small pieces (headers, chunk framing): one send.
+                    pieces = []
+                    size = 0
+                    while out and size < self.coalesce_size:
+                        piece = out.popleft()
+                        pieces.append(piece)
+                        size += len(piece)
+                    out.appendleft("".join(pieces))
+                try:
+                    sent = self.socket.send(out[0])
+                except socket.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self._out_bytes -= sent
+                if sent < len(out[0]):
+                    out[0] = out[0][sent:]
+                    break
+                out.popleft()
+            if self._out_bytes <= self.high_water:
+                self._out_cond.notifyAll()
+            return not out
+        finally:
+            self._out_cond.release()
+
+    def communicate(self):
+        """Answer the request parsed on the loop (in a worker thread).
+
+        Returns True if the connection should be kept open for the next
+        request, as HTTPConnection.communicate does.
+        """
+        req = self.request
+        stats = self.server.stats_collector
+        start = time.time()
+        try:
+            try:
+                req.respond()
+            finally:
+                self.request = None
+            if stats is not None:
+                stats.record(req.mount_point, req.status,
+                             start - getattr(self, "queued_at", start),
+                             self.parse_time, time.time() - start,
+                             req.bytes_written)
+            return not req.close_connection
+        except socket.error, e:
+            if e.args[0] not in socket_errors_to_ignore:
+                try:
+                    req.simple_response("500 Internal Server Error",
+                                        format_exc())
+                except socket.error:
+                    pass
+            return False
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except MaxSizeExceeded:
+            if not req.sent_headers:
+                req.simple_response("413 Request Entity Too Large")
+            return False
+        except:
+            if stats is not None:
+                stats.error()
+            req.simple_response("500 Internal Server Error", format_exc())
+            return False
+
+    def close(self):
+        """Close the connection once its queued output is sent."""
+        loop = self.server.selector
+        if loop is None or loop.in_loop():
+            self._close_soon()
+        else:
+            loop.call(self._close_soon)
+
+    def _close_soon(self):
+        if self.closed:
+            return
+        if self.channel is not None and self.has_output():
+            self.closing = True
+        else:
+            self.close_now()
+
+    def close_now(self):
+        """Close the connection, discarding any queued output."""
+        self._out_cond.acquire()
+        try:
+            if self.closed:
+                return
+            channel, self.channel = self.channel, None
+            if channel is not None:
+                channel.del_channel()
+            self._out.clear()
+            self._out_bytes = 0
+            HTTPConnection.close(self)
+            self._out_cond.notifyAll()
+        finally:
+            self._out_cond.release()
+
+
+class _Channel(asyncore.dispatcher):
+
+    def __init__(self, conn, loop):
+        asyncore.dispatcher.__init__(self, conn.socket, map=loop.map)
+        self.conn = conn
+        self.loop = loop
+
+    def readable(self):
+        conn = self.conn
+        rfile = conn.rfile
+        return (not conn.closing and not rfile.eof
+                and rfile.pending < conn.high_water)
+
+    def writable(self):
+        return self.conn.has_output()
+
+    def handle_read(self):
+        self.loop._read(self.conn)
+
+    def handle_write(self):
+        self.loop._write(self.conn)
+
+    def handle_expt(self):
+        self.conn.close_now()
+
+    def handle_close(self):
+        self.conn.close_now()
+
+    def handle_error(self):
+        LOG.error('Error on connection %s', self.conn.addr, exc_info=True)
+        self.conn.close_now()
+
+
+class _Listener(asyncore.dispatcher):
+
+    def __init__(self, sock, loop):
+        asyncore.dispatcher.__init__(self, sock, map=loop.map)
+        self.loop = loop
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        for conn in self.loop.server.accept_many():
+            self.loop.add(conn)
+
+    def handle_error(self):
+        LOG.error('Error accepting connections', exc_info=True)
+
+
+class _Waker(asyncore.dispatcher):
+
+    def __init__(self, pipe, loop):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.pipe = pipe
+        self._fileno = pipe.fileno()
+        self.add_channel(loop.map)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        self.pipe.drain()
+
+    def close(self):
+        self.del_channel()
+        self.pipe.close()
+
+
+class EventLoop(object):
+    """The asyncore event loop of an AsyncWSGIServer.
+
+    It takes the place of a ConnectionSelector: the server's tick() calls
+    poll(), workers park() connections when they have answered a request,
+    and admission control can evict() idle ones. Other threads pass work
+    to the loop with call().
+    """
+
+    sweep_interval = 1.0
+
+    def __init__(self, server):
+        self.server = server
+        self.map = {}
+        self._lock = threading.Lock()
+        self._calls = []
+        self._thread = None
+        self._last_sweep = time.time()
+        self.closed = False
+        # AsyncConnection -> None, for every connection on the loop
+        self._conns = {}
+        self._waker = _Waker(WakeupPipe(), self)
+
+    def __len__(self):
+        """Return the number of connections on the loop."""
+        return len(self._conns)
+
+    def in_loop(self):
+        """Return True if called from the thread running the loop."""
+        return self._thread is threading.currentThread()
+
+    def add_listener(self, sock):
+        sock.setblocking(0)
+        _Listener(sock, self)
+
+    def wakeup(self):
+        """Interrupt a poll() in progress (safe to call from any thread)."""
+        self._waker.pipe.wakeup()
+
+    def call(self, func, *args):
+        """Have the loop call func(*args) (safe to call from any thread)."""
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return
+            self._calls.append((func, args))
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+    def park(self, conn):
+        """A worker has answered conn's request; wait for the next one."""
+        self.call(self._idle, conn)
+
+    def add(self, conn):
+        """Start serving a newly accepted connection."""
+        conn.channel = _Channel(conn, self)
+        conn.last_active = time.time()
+        self._conns[conn] = None
+
+    def evict(self, count):
+        """Close up to count of the longest idle connections; return how many."""
+        idle = [conn for conn in self._conns
+                if not (conn.busy or conn.closed or conn.has_output())]
+        oldest = heapq.nsmallest(count, idle, key=lambda c: c.last_active)
+        for conn in oldest:
+            self._forget(conn)
+            conn.close_now()
+        return len(oldest)
+
+    def _forget(self, conn):
+        self._conns.pop(conn, None)
+
+    def _read(self, conn):
+        try:
+            data = conn.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._forget(conn)
+            conn.close_now()
+            return
+        conn.rfile.feed(data)
+        if not data:
+            if not conn.busy:
+                self._forget(conn)
+                conn.close()
+            return
+        conn.last_active = time.time()
+        if not conn.busy:
+            self._next_request(conn)
+        elif conn.awaiting_body is not None:
+            self._check_body(conn)
+
+    def _write(self, conn):
+        try:
+            done = conn.flush()
+        except socket.error:
+            self._forget(conn)
+            conn.close_now()
+            return
+        conn.last_active = time.time()
+        if done and conn.closing:
+            self._forget(conn)
+            conn.close_now()
+
+    def _idle(self, conn):
+        conn.busy = False
+        conn.last_active = time.time()
+        if conn.closed:
+            self._forget(conn)
+        else:
+            self._next_request(conn)
+
+    def _next_request(self, conn):
+        """Parse and dispatch the next request, if its head has arrived."""
+        rfile = conn.rfile
+        rfile.absorb()
+        if not (rfile.has_head() or
+                rfile.buffered() > self.server.max_request_header_size):
+            if rfile.eof:
+                self._forget(conn)
+                conn.close()
+            return
+
+        conn.busy = True
+        req = conn.RequestHandlerClass(conn)
+        start = time.time()
+        try:
+            req.parse_request()
+        except:
+            LOG.error('Error parsing request', exc_info=True)
+            req.close_connection = True
+            req.simple_response("400 Bad Request")
+        conn.parse_time = time.time() - start
+        if not req.ready:
+            self._forget(conn)
+            conn.close()
+            return
+
+        conn.request = req
+        if not getattr(req.wsgi_app, "asynchronous", False):
+            self.server.requests.put(conn)
+            return
+
+        body = req.body
+        if isinstance(body, ChunkedRFile):
+            req.close_connection = True
+            req.simple_response("411 Length Required")
+            self._forget(conn)
+            conn.close()
+            return
+        if body is not None and not body.done:
+            # Ask for the body (with "100 Continue" if it's expected)
+            # and wait until it has all arrived.
+            body._begin()
+            conn.awaiting_body = body.remaining
+            self._check_body(conn)
+        else:
+            self._call_app(conn, req)
+
+    def _check_body(self, conn):
+        rfile = conn.rfile
+        rfile.absorb()
+        if rfile.buffered() >= conn.awaiting_body or rfile.eof:
+            conn.awaiting_body = None
+            self._call_app(conn, conn.request)
+
+    def _call_app(self, conn, req):
+        memory = self.server.memory_collector
+        if memory is not None:
+            conn.memory_token = memory.begin()
+        try:
+            result = req.wsgi_app(req.environ, req.start_response)
+        except:
+            self._finish(conn, req, (None, sys.exc_info()))
+            return
+        if isinstance(result, PendingResponse):
+            result._then(lambda outcome: self.call(self._finish, conn, req,
+                                                   outcome))
+        else:
+            self._finish(conn, req, (result, None))
+
+    def _finish(self, conn, req, outcome):
+        body, exc_info = outcome
+        conn.request = None
+        memory = self.server.memory_collector
+        if memory is not None:
+            memory.end(req.mount_point, conn.memory_token)
+        if conn.closed:
+            if hasattr(body, "close"):
+                body.close()
+            self._forget(conn)
+            return
+        stats = self.server.stats_collector
+        start = time.time()
+        try:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            req.send_response(body)
+        except socket.error:
+            req.close_connection = True
+        except:
+            LOG.error('Error in asynchronous app', exc_info=True)
+            if stats is not None:
+                stats.error()
+            req.close_connection = True
+            if not req.sent_headers:
+                try:
+                    req.simple_response("500 Internal Server Error",
+                                        format_exc())
+                except socket.error:
+                    pass
+        exc_info = None
+        if stats is not None:
+            stats.record(req.mount_point, req.status, 0.0, conn.parse_time,
+                         time.time() - start, req.bytes_written)
+        if req.close_connection:
+            self._forget(conn)
+            conn.close()
+        else:
+            self._idle(conn)
+
+    def _run_calls(self):
+        self._lock.acquire()
+        try:
+            calls, self._calls = self._calls, []
+        finally:
+            self._lock.release()
+        for func, args in calls:
+            try:
+                func(*args)
+            except:
+                LOG.error('Error in event loop call', exc_info=True)
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (None = no limit) and handle events."""
+        self._thread = threading.currentThread()
+        asyncore.poll2(timeout, self.map)
+        self._run_calls()
+
+        now = time.time()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            deadline = now - self.server.keepalive_timeout
+            # Closed by its worker, but the client isn't reading the rest.
+            write_deadline = now - self.server.timeout
+            for conn in self._conns.keys():
+                if conn.closed:
+                    self._forget(conn)
+                elif (conn.last_active < deadline and
+                      (not conn.busy or conn.awaiting_body is not None)) or (
+                        conn.closing and conn.last_active < write_deadline):
+                    self._forget(conn)
+                    conn.close_now()
+
+    def close(self):
+        """Close every connection and stop watching all sockets."""
+        self._lock.acquire()
+        try:
+            self.closed = True
+            self._calls = []
+        finally:
+            self._lock.release()
+        for conn in self._conns.keys():
+            self._forget(conn)
+            conn.close_now()
+        self._waker.close()
+        for channel in self.map.values():
+            channel.del_channel(self.map)
+        self.map.clear()
+
+
+class AsyncWSGIServer(CherryPyWSGIServer):
+    """An HTTP server for WSGI, doing its socket I/O on one event loop.
+
+    Takes the same arguments and options as CherryPyWSGIServer (use_selector
+    is implied). The ThreadPool only runs applications: min_threads and
+    max_threads bound how many (synchronous) app calls run at once, while
+    any number of connections wait on the loop. Apps wrapped with
+    @asynchronous are called on the loop itself. SSL is not supported.
+    """
+
+    ConnectionClass = AsyncConnection
+    SelectorClass = EventLoop
+
+    def __init__(self, *args, **kwargs):
+        kwargs["use_selector"] = True
+        CherryPyWSGIServer.__init__(self, *args, **kwargs)
+
+    def start(self):
+        if self.ssl_certificate or self.ssl_private_key:
+            raise ValueError("AsyncWSGIServer does not support SSL.")
+        CherryPyWSGIServer.start(self)
+
+    def reject(self, conn):
+        if conn.channel is None:
+            # Not on the loop yet: send what the socket will take now.
+            CherryPyWSGIServer.reject(self, conn)
+            return
+        if self.stats_collector is not None:
+            self.stats_collector.rejected()
+        try:
+            conn.queue_output([self.busy_response()])
+        except socket.error:
+            pass
+        conn.close()
@@ -7,16 +7,62 @@ import socket
 import os
 from cgi import FieldStorage
 import signal
-from struct import pack, unpack, calcsize
+from struct import pack, unpack, unpack_from, calcsize, error as struct_error
 from cStringIO import StringIO
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from urllib import unquote
 import logging
 import re
+import errno
+import fcntl
+import Queue
+from threading import RLock, Lock, Thread, Condition
+from shotlib.properties import PackedRecord
+from shotlib.wsgiserver import MountTable, FileWrapper, memory_usage
+from shotlib.prefork import Prefork, Scoreboard, IDLE, ACTIVE, FULL
 
 LOG = logging.getLogger('shotlib.fastcgi')
 
 
 FCGI_LISTENSOCK_FILENO = 0   # Listening socket file number
 
+if hasattr(socket, 'SO_DOMAIN'):
+    SO_DOMAIN = socket.SO_DOMAIN
+elif sys.platform.startswith('linux'):
+    # Python 2's socket module doesn't export it.
+    SO_DOMAIN = 39
+else:
+    SO_DOMAIN = None
+
+def inherited_listener():
+    """Return the listening socket a web server passed us (as stdin, i.e.
+    FCGI_LISTENSOCK_FILENO), or None if stdin is not one."""
+    try:
+        sock = socket.fromfd(FCGI_LISTENSOCK_FILENO, socket.AF_INET,
+                             socket.SOCK_STREAM)
+    except (socket.error, OSError):
+        return None
+    try:
+        sock.getpeername()
+    except socket.error, e:
+        if e.args[0] != errno.ENOTCONN:
+            # not a socket at all
+            sock.close()
+            return None
+    else:
+        # a connected socket, not a listening one
+        sock.close()
+        return None
+    if SO_DOMAIN is not None:
+        family = sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        if family != socket.AF_INET:
+            listener = socket.fromfd(FCGI_LISTENSOCK_FILENO, family,
+                                     socket.SOCK_STREAM)
+            sock.close()
+            sock = listener
+    return sock
+
 #typedef struct {
 #    unsigned char version;
 #    unsigned char type;
@@ -160,31 +206,26 @@ class DataPromise(object):
 
 
 class Record(object):
-    def __init__(self, header):
-        self.header = header
-        self.content = []
-        self.bytes = 0
-
-    def add(self, bytes):
-        self.bytes += len(bytes)
-        self.content.append(bytes)
+    """A record received by a Recordinator.
 
-    def _get_complete(self):
-        return self.needs <= 0
+    content is a memoryview of the record's body in the Recordinator's
+    buffer; it is only valid until the next fill() or feed(), so anything
+    kept must be copied -- content_data does, once, on first use.
+    """
+    __slots__ = ['type', 'request_id', 'content', '_data']
 
-    def _get_needs(self):
-        return self.header.total_bytes - self.bytes
-
-    
-    needs = property(_get_needs)
-    complete = property(_get_complete)
+    def __init__(self, type, request_id, content):
+        self.type = type
+        self.request_id = request_id
+        self.content = content
+        self._data = None
 
-    request_id = property(lambda self:self.header.request_id)
-    type = property(lambda self:self.header.type)
+    def _get_content_data(self):
+        if self._data is None:
+            self._data = self.content.tobytes()
+        return self._data
 
-    def finish(self):        
-        self.content_data = (''.join(self.content))[:self.header.body_length]
-        del self.content
+    content_data = property(_get_content_data)
 
 HIGH_BIT = 1L << 31
 NOT_HIGH_BIT = ~HIGH_BIT
@@ -209,7 +250,7 @@ class NameValuePair(list):
 
     def pack_length(l):
         if l > 127:
-            return pack('!I', l | HIGH_BIT)[0] 
+            return pack('!I', l | HIGH_BIT)
         else:
             return chr(l)
 
@@ -249,6 +290,37 @@ class NameValuePairs(list):
             offset, pair = NameValuePair.read(data, offset)
             yield pair
 
+def decode_params(data, environ):
+    """Decode FCGI_PARAMS name-value pairs from data into the environ dict.
+
+    Raises ValueError if data ends part way through a pair.
+    """
+    offset = 0
+    end = len(data)
+    try:
+        while offset < end:
+            name_length = ord(data[offset])
+            if name_length & 128:
+                name_length = unpack_from('!I', data, offset)[0] & NOT_HIGH_BIT
+                offset += 4
+            else:
+                offset += 1
+            value_length = ord(data[offset])
+            if value_length & 128:
+                value_length = unpack_from('!I', data, offset)[0] & NOT_HIGH_BIT
+                offset += 4
+            else:
+                offset += 1
+            name_end = offset + name_length
+            value_end = name_end + value_length
+            if value_end > end:
+                raise IndexError(value_end)
+            environ[data[offset:name_end]] = data[name_end:value_end]
+            offset = value_end
+    except (IndexError, struct_error):
+        raise ValueError('FastCGI params truncated at byte %d' % offset)
+    return environ
+
 def pack_record(type, request_id, body):
     if isinstance(body, DataPromise):
         l = body.length
@@ -273,139 +345,336 @@ def pack_record(type, request_id, body):
         yield '\x00' * padding
 #    LOG.debug('done')
 
-class Recordinator(object):
-    def __init__(self):
-        self.__bytes = ''
-        self.__record = None
+# A record body's length is 16 bits.
+MAX_RECORD_BODY = 65535
+# The longest body needing no padding
+MAX_RECORD_WINDOW = MAX_RECORD_BODY & ~7
+
+_PADDING = ['\x00' * i for i in xrange(8)]
+
+def frame_records(type, request_id, data):
+    """Return a list of pieces framing data as records of the given type.
+
+    Data longer than MAX_RECORD_BODY is split over memoryview windows of
+    it, so even a multi-megabyte body is framed without copying it. The
+    windows are of (nearly) equal size, a multiple of 8, so that only the
+    last record needs padding and none is left with a sliver of data (a
+    64KB chunk is two 32KB records, not 65535 bytes and 1).
+    """
+    length = len(data)
+    if length <= MAX_RECORD_BODY:
+        padding = -length & 7
+        if not length:
+            # (an empty record would end the stream)
+            return []
+        pieces = [pack('!BBHHBB', FCGI_VERSION_1, type, request_id,
+                       length, padding, 0), data]
+        if padding:
+            pieces.append(_PADDING[padding])
+        return pieces
+    count = (length + MAX_RECORD_WINDOW - 1) // MAX_RECORD_WINDOW
+    window = ((length + count - 1) // count + 7) & ~7
+    data = memoryview(data)
+    pieces = []
+    for start in xrange(0, length, window):
+        body = data[start:start + window]
+        padding = -len(body) & 7
+        pieces.append(pack('!BBHHBB', FCGI_VERSION_1, type, request_id,
+                           len(body), padding, 0))
+        pieces.append(body)
+        if padding:
+            pieces.append(_PADDING[padding])
+    return pieces
+
+def frame_stream(type, request_id, chunks):
+    """Frame an iterable of strings as records, lazily (a generator).
+
+    Each chunk is framed as it is produced; empty chunks are skipped, as
+    an empty record would end the stream.
+    """
+    for chunk in chunks:
+        if chunk:
+            for piece in frame_records(type, request_id, chunk):
+                yield piece
+
+def _read_blocks(f, size=MAX_RECORD_WINDOW):
+    try:
+        while True:
+            block = f.read(size)
+            if not block:
+                return
+            yield block
+    finally:
+        f.close()
 
-    def feed(self, data):
+_HEADER_FORMAT = '!BBHHBx'
+
+class Recordinator(object):
+    """Splits a stream of FastCGI records out of one reusable buffer.
+
+    fill() receives straight into the free end of the buffer (recv_into)
+    and records() parses every complete record there, unpacking headers
+    in place (unpack_from) and handing out bodies as memoryviews, so a
+    byte is copied only if whoever handles the record keeps it. Consumed
+    bytes are reclaimed by moving any partial record to the front before
+    the next receive; the buffer grows if a single record needs it.
+
+    read_size: the most bytes to receive per fill() to start with. It
+        doubles (up to max_read_size) whenever a fill() gets all it asked
+        for, so a client streaming a big body is read in few calls.
+    """
+
+    read_size = 16384
+    max_read_size = 262144
+
+    def __init__(self, read_size=None, max_read_size=None):
+        if read_size:
+            self.read_size = read_size
+        if max_read_size:
+            self.max_read_size = max_read_size
+        self._buf = bytearray(self.read_size * 4)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        # the size of the partial record at _start, once its header is in
+        self._needs = FCGI_HEADER_LEN
+
+    def _make_room(self, size):
+        """Make sure there is room for size more bytes after _end."""
+        buf = self._buf
+        pending = self._end - self._start
+        if pending + size > len(buf):
+            # A bytearray can't be resized while views of it exist, so
+            # move to a new one.
+            self._buf = bytearray(max(pending + size, len(buf) * 2))
+            self._buf[:pending] = buf[self._start:self._end]
+            self._view = memoryview(self._buf)
+        elif self._start and (self._end + size > len(buf) or
+                              self._start >= len(buf) // 2):
+            buf[:pending] = buf[self._start:self._end]
+        else:
+            return
+        self._start = 0
+        self._end = pending
+
+    def fill(self, recv_into):
+        """Receive once into the buffer; returns recv_into's result.
+
+        recv_into(view) must receive into the given memoryview and return
+        the number of bytes received (e.g. socket.recv_into).
+        """
+        size = self.read_size
+        # Room for the rest of a partial record, if that is more.
+        self._make_room(max(self._needs - (self._end - self._start), size))
+        n = recv_into(self._view[self._end:self._end + size])
+        if n:
+            self._end += n
+            if n >= size and size < self.max_read_size:
+                self.read_size = min(size * 2, self.max_read_size)
+        return n
+
+    def records(self):
+        """Return the complete records received so far."""
+        buf = self._buf
+        view = self._view
+        start = self._start
+        end = self._end
         records = []
-        if self.__bytes:
-            data = self.__bytes + data
-            self.__bytes = ''
-        while data:            
-            if self.__record:
-                l = self.__record.needs
-                if len(data) < l:
-                    self.__record.add(data)
-                    data = ''
-                else:
-                    self.__record.add(data[:l])
-                    self.__record.finish()
-                    records.append(self.__record)
-                    self.__record = None
-                    data = data[l:]
-            else:
-                if len(data) >= FCGI_HEADER_LEN:
-                    header = Header(data[:FCGI_HEADER_LEN])
-                    self.__record = Record(header)
-                    data = data[FCGI_HEADER_LEN:]
-                else:
-                    self.__bytes = data
-                    data = ''
-        if self.__record:
-            if self.__record.complete:
-                records.append(self.__record)
-                self.__record.finish()                
-                self.__record = None
+        while end - start >= FCGI_HEADER_LEN:
+            (version, type, request_id, body_length,
+             padding_length) = unpack_from(_HEADER_FORMAT, buf, start)
+            size = FCGI_HEADER_LEN + body_length + padding_length
+            if end - start < size:
+                self._needs = size
+                break
+            body = start + FCGI_HEADER_LEN
+            records.append(Record(type, request_id,
+                                  view[body:body + body_length]))
+            start += size
+        else:
+            self._needs = FCGI_HEADER_LEN
+        if start == end:
+            self._start = self._end = 0
+        else:
+            self._start = start
         return records
 
+    def feed(self, data):
+        """Add data received some other way; returns the complete records."""
+        self._make_room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return self.records()
+
 
 class RecordConnection(asyncore.dispatcher):
+    """An asyncore dispatcher speaking FastCGI records.
+
+    Output is a queue of pieces (record headers, bodies, padding) rather
+    than a generator per record. handle_write gathers up to send_batch
+    bytes of them per send: with sendmsg() (Python 3.3+) as one iovec,
+    otherwise joining the pieces shorter than gather_limit, and the first
+    big piece after them, so that a run of small records goes out in one
+    send() and no record header is sent apart from its body. (A big piece
+    at the front of the queue is sent as it is.) A partial send leaves a
+    memoryview of the rest of the piece at the front of the queue, so
+    nothing is copied to retry it.
+    """
+    # See Recordinator
+    read_size = 16384
+    max_read_size = 262144
+    send_batch = 65536
+    gather_limit = 16384
+
     def __init__(self, *args, **kargs):
         asyncore.dispatcher.__init__(self, *args, **kargs)
-        self.__parser = Recordinator()
-        self.__outbound = []
-        self.__working_data = None
-        self.__working_offset = 0
-        self.__writable = False
+        self.__parser = Recordinator(self.read_size, self.max_read_size)
+        # str/memoryview pieces, or iterators producing them lazily
+        self.__outbound = deque()
         self.__close_when_flushed = False
         self.__buflock = RLock()
 
     def writable(self):
-        return self.__writable
-
-    def next_data(self):
-        try:
-            self.__buflock.acquire()        
-            while True:
-                if not self.__outbound:
-                    return None
+        return bool(self.__outbound)
+
+    def _gather(self):
+        """Take the next send_batch bytes or so off the output queue."""
+        out = self.__outbound
+        pieces = []
+        size = 0
+        while out and size < self.send_batch:
+            item = out[0]
+            if isinstance(item, (str, memoryview)):
+                out.popleft()
+            else:
                 try:
-                    return self.__outbound[0].next()
+                    item = item.next()
                 except StopIteration:
-                    del self.__outbound[0]
-        finally:
-            self.__buflock.release()
-                
+                    out.popleft()
+                    continue
+                if not item:
+                    continue
+            pieces.append(item)
+            size += len(item)
+        return pieces
+
+    def _send_pieces(self, pieces):
+        """Send (a prefix of) pieces; return the number of bytes sent."""
+        sendmsg = getattr(self.socket, 'sendmsg', None)
+        if sendmsg is not None:
+            return sendmsg(pieces)
+        if len(pieces) == 1 or len(pieces[0]) >= self.gather_limit:
+            return self.socket.send(pieces[0])
+        batch = []
+        for piece in pieces:
+            if not isinstance(piece, str):
+                piece = piece.tobytes()
+            batch.append(piece)
+            if len(piece) >= self.gather_limit:
+                # A header goes out with (the start of) its body.
+                break
+        return self.socket.send(''.join(batch))
 
     def handle_write(self):
         total = 0
-        while True:
-            if not self.__working_data:
-                self.__working_data = self.next_data()
-                if self.__working_data:
-                    self.__working_offset = 0
-#                    LOG.debug('got working data')
-                    self.__working_length = len(self.__working_data)
-#                    LOG.debug('New working data %d', self.__working_length)
-            if not self.__working_data:
-#                LOG.debug('Out of working data')
-                self.__writable = False
-                if self.__close_when_flushed:
-                    self.close()
-                return            
-            try:
-#                LOG.debug('Sending from %d', self.__working_offset)
-                sent = self.send(self.__working_data[self.__working_offset:])
-            except:
-                LOG.warn('buffer write failed', exc_info=sys.exc_info())
-#            LOG.debug('Sent %d', sent)
-            if sent:
-                self.__working_offset += sent
+        self.__buflock.acquire()
+        try:
+            out = self.__outbound
+            while out:
+                pieces = self._gather()
+                if not pieces:
+                    break
+                try:
+                    sent = self._send_pieces(pieces)
+                except socket.error, why:
+                    out.extendleft(reversed(pieces))
+                    if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN,
+                                       errno.EINTR):
+                        break
+                    if why.args[0] in asyncore._DISCONNECTED:
+                        self.handle_close()
+                        return
+                    raise
                 total += sent
-                if self.__working_offset >= self.__working_length:
-                    self.__working_data = None
-            else:
-                break
+                i = 0
+                while i < len(pieces) and sent >= len(pieces[i]):
+                    sent -= len(pieces[i])
+                    i += 1
+                if i < len(pieces):
+                    if sent:
+                        pieces[i] = memoryview(pieces[i])[sent:]
+                    out.extendleft(reversed(pieces[i:]))
+                    # The socket buffer is full.
+                    break
+            flushed = not out
+        finally:
+            self.__buflock.release()
         LOG.debug('Wrote %d bytes', total)
+        if flushed and self.__close_when_flushed:
+            self.close()
 
     def flush_close(self):
-        if self.__writable:
+        if self.__outbound:
             self.__close_when_flushed = True
         else:
             self.close()
 
     def send_buffered(self, data_source):
-        if isinstance(data_source, str):
-            data_source = iter((data_source,))
-        else:
-            data_source = iter(data_source)
+        """Queue a string, or an iterable of strings to be sent lazily."""
         self.__buflock.acquire()
-        try:            
-            self.__outbound.append(data_source)
-            self.__writable = True
+        try:
+            if isinstance(data_source, (str, memoryview)):
+                if data_source:
+                    self.__outbound.append(data_source)
+            else:
+                self.__outbound.append(iter(data_source))
         finally:
             self.__buflock.release()
 
+    def send_stream(self, type, request_id, chunks):
+        """Send an iterable of strings as records, pulling it lazily."""
+        self.send_buffered(frame_stream(type, request_id, chunks))
+
     def send_record(self, type, request_id, data=None, rb=None):
-#        LOG.debug('Connection.send_Record')
         if rb:
-#            LOG.debug('Packing %s', repr(rb))
             data = rb.pack()
-#        LOG.debug('Send record (%d, %d, %s)', type, request_id, repr(data))
-        self.send_buffered(pack_record(type, request_id, data))
-    
+        if isinstance(data, DataPromise):
+            length = data.length
+        else:
+            length = data and len(data) or 0
+        if length > MAX_RECORD_BODY and not isinstance(data, DataPromise):
+            self.__buflock.acquire()
+            try:
+                self.__outbound.extend(frame_records(type, request_id, data))
+            finally:
+                self.__buflock.release()
+            return
+        padding = -length & 7
+        header = pack('!BBHHBB', FCGI_VERSION_1, type, request_id, length,
+                      padding, 0)
+        self.__buflock.acquire()
+        try:
+            out = self.__outbound
+            out.append(header)
+            if isinstance(data, DataPromise):
+                out.append(iter(data))
+            elif length:
+                out.append(data)
+            if padding:
+                out.append(_PADDING[padding])
+        finally:
+            self.__buflock.release()
+
+    def values(self):
+        return VALUES
 
     def _get_values(self, record):
         request = NameValuePairs(data=record.content_data)
         result = NameValuePairs()
-        for name, x in result:
-            try:
-                val = VALUES[name]
-                result.add(name, val)
-            except:
-                pass
+        values = self.values()
+        for name, x in request:
+            if name in values:
+                result.add(name, values[name])
         LOG.debug('FCGI_GET_VALUES_RESULT sent')
         self.send_record(FCGI_GET_VALUES_RESULT,
                          record.request_id,
@@ -415,17 +684,183 @@ class RecordConnection(asyncore.dispatcher):
     def dispatch_record(self, record):
         LOG.warn('Unhandled record: %d', record.type)
     
+    def recv_into(self, view):
+        # asyncore.dispatcher.recv(), for a buffer
+        try:
+            n = self.socket.recv_into(view)
+        except socket.error, why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                n = 0
+            elif why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN,
+                                 errno.EINTR):
+                return None
+            else:
+                raise
+        if not n:
+            self.handle_close()
+        return n
+
     def handle_read(self):
-#        LOG.debug('Handle read')
-        data = self.recv(1024)
-        if not data:
-            self.close()
-        for record in self.__parser.feed(data):
-            self.dispatch_record(record)
+        # Read until the socket is drained, rather than once per trip
+        # around the asyncore loop.
+        parser = self.__parser
+        while True:
+            size = parser.read_size
+            n = parser.fill(self.recv_into)
+            if not n:
+                return
+            for record in parser.records():
+                self.dispatch_record(record)
+            if n < size or self._fileno is None or not self.readable():
+                # Short read (nothing more waiting), closed meanwhile, or
+                # holding off until what we have is consumed
+                return
+
+class WakeupChannel(asyncore.file_dispatcher):
+    """The read end of a pipe in the asyncore map, so that other threads
+    can interrupt asyncore.loop() to have it run Dispatcher.call()s."""
+
+    def __init__(self, dispatcher, map=None):
+        r, w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map)
+        os.close(r)
+        flags = fcntl.fcntl(w, fcntl.F_GETFL)
+        fcntl.fcntl(w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._write_fd = w
+        self.dispatcher = dispatcher
+
+    def wakeup(self):
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError, e:
+            # A full pipe will wake the loop anyway.
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        self.dispatcher.run_calls()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+class Dispatcher(object):
+    """Runs FastCGI requests on a bounded pool of threads.
+
+    Connections parse records on the asyncore thread and submit() each
+    complete request here; a worker thread runs it. Everything the request
+    sends is passed back with call(), which queues it for the asyncore
+    thread and wakes it, so connections' buffers and sockets are only ever
+    touched by asyncore.loop(). A slow request no longer holds up the other
+    requests multiplexed on its connection, or the loop.
+
+    threads: the number of worker threads.
+    max_requests: the most requests admitted at once (FCGI_MAX_REQS);
+        beyond that, new requests are refused with FCGI_OVERLOADED.
+    """
+
+    def __init__(self, threads=10, max_requests=50, map=None):
+        self.threads = threads
+        self.max_requests = max_requests
+        self.active = 0
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = Lock()
+        self._calls = []
+        self._waker = WakeupChannel(self, map)
+
+    def admit(self):
+        """Count a new request, if there is room for it (asyncore thread)."""
+        if self.active >= self.max_requests:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        """Count a request as finished (asyncore thread)."""
+        self.active -= 1
+
+    def submit(self, func, *args):
+        """Have a worker thread call func(*args)."""
+        if not self._workers:
+            self.start()
+        self._queue.put((func, args))
+
+    def wakeup(self):
+        """Interrupt asyncore.loop() (safe even in a signal handler)."""
+        self._waker.wakeup()
+
+    def call(self, func, *args, **kw):
+        """Have the asyncore thread call func(*args, **kw) (from any thread)."""
+        self._lock.acquire()
+        try:
+            wake = not self._calls
+            self._calls.append((func, args, kw))
+        finally:
+            self._lock.release()
+        if wake:
+            self._waker.wakeup()
+
+    def run_calls(self):
+        self._lock.acquire()
+        try:
+            calls, self._calls = self._calls, []
+        finally:
+            self._lock.release()
+        for func, args, kw in calls:
+            try:
+                func(*args, **kw)
+            except:
+                LOG.error('Error in dispatched call', exc_info=True)
+
+    def start(self):
+        for i in xrange(self.threads):
+            worker = Thread(target=self._work,
+                            name='FastCGI worker %d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            func, args = item
+            try:
+                func(*args)
+            except:
+                LOG.error('Error in worker thread', exc_info=True)
+
+    def stop(self):
+        """Stop the worker threads once the requests queued have run."""
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._waker.close()
 
 CONNECTION_COUNT = 0
 
 class Connection(RecordConnection):
+    # The Dispatcher to run requests on, or None to run them inline.
+    dispatcher = None
+    # Request bodies are kept in memory up to this many bytes, and in a
+    # temporary file beyond that.
+    spool_size = 1024 * 1024
+    # With a dispatcher, start requests as soon as their params are in,
+    # giving them a StreamingInput as stdin (instead of a spooled copy
+    # of the whole body).
+    stream_stdin = False
+
     def __init__(self, *args, **kargs):        
         RecordConnection.__init__(self, *args, **kargs)
         global CONNECTION_COUNT
@@ -441,17 +876,29 @@ class Connection(RecordConnection):
         self.__request_dispatch = {FCGI_RESPONDER : self._begin_responder}
         
     def dispatch_record(self, record):
-        try:
-            handler = self.__dispatch[record.type]
+        handler = self.__dispatch.get(record.type)
+        if handler is not None:
             handler(record)
-        except KeyError:
-            # unknown record!
-            pass
 
 
+    def values(self):
+        if self.dispatcher is None:
+            return VALUES
+        values = dict(VALUES)
+        values[FCGI_MAX_REQS] = str(self.dispatcher.max_requests)
+        return values
+
     def rqget(self, record):
         return self.__requests.get(record.request_id)
 
+    def readable(self):
+        # Stop reading while an app is behind on a streamed stdin (its
+        # on_drain wakes the loop to look again).
+        for rq in self.__requests.itervalues():
+            if rq.streaming and rq.stdin.full:
+                return False
+        return True
+
     def _abort_request(self, record):
         rq = self.rqget(record)
         if rq:
@@ -462,9 +909,13 @@ class Connection(RecordConnection):
         if not rq:
             return
         if record.content_data:
-            rq.add_params(NameValuePairs(record.content_data))
-        else:
+            rq.add_params_data(record.content_data)
+            return
+        try:
             rq.finish_params()
+        except ValueError:
+            LOG.warn('%d: Bad params', record.request_id, exc_info=True)
+            rq.abort()
 
     def _request_stdin(self, record):
         rq = self.rqget(record)
@@ -493,6 +944,15 @@ class Connection(RecordConnection):
 
     def _begin_responder(self, req, body):
         LOG.debug('Start request %d.%d', self.id, req.request_id)
+        if self.dispatcher is not None and not self.dispatcher.admit():
+            LOG.warn('%d: Overloaded; refusing request', req.request_id)
+            self.send_record(FCGI_END_REQUEST,
+                             req.request_id,
+                             rb=EndRequestBody(appStatus=0,
+                                               protocolStatus=FCGI_OVERLOADED))
+            if not body.shouldKeepConn:
+                self.flush_close()
+            return
         request = Request(self, req.request_id, body)
         request.deferred = False
         request.begin_time = time.time()
@@ -502,7 +962,10 @@ class Connection(RecordConnection):
         now = time.time()
         LOG.debug('End request %d.%d (%.2fms)', self.id, req.request_id,
                  (now - req.begin_time)*1000.)
-        del self.__requests[req.request_id]
+        if self.__requests.pop(req.request_id, None) is None:
+            return
+        if self.dispatcher is not None:
+            self.dispatcher.release()
 
     def run_request(self, request):
         pass
@@ -511,21 +974,31 @@ class Connection(RecordConnection):
         pass
 
     def execute_request(self, request):
-        def execute():
-            try:
-                self.run_request(request)
-            except:
-                self.handle_traceback(request, sys.exc_info())
-            if not request.deferred:
-                request.end()
-        name = 'Execute request %d' % request.request_id
-        execute()
-#        Thread(target=execute, name=name).start()
+        if self.dispatcher is None:
+            self._execute(request)
+        else:
+            request.dispatcher = self.dispatcher
+            self.dispatcher.submit(self._execute, request)
+
+    def _execute(self, request):
+        request.running = True
+        if request.aborted:
+            request.end()
+            return
+        try:
+            self.run_request(request)
+        except:
+            self.handle_traceback(request, sys.exc_info())
+        request.running = False
+        if not request.deferred or request.aborted:
+            request.end()
 
     def handle_close(self):
         LOG.debug('Connection %d closed', self.id)
-        for key, v in self.__requests:
+        for key, rq in self.__requests.items():
             LOG.warn('Pending request %d.%d did not complete', self.id, key)
+            rq.abandon()
+            self.finish_request(rq)
         self.close()
 
 
@@ -537,16 +1010,27 @@ class RecordOutputStream(object):
         self._closed = False
 
     def write(self, data):
+        """Send data: a string, a DataPromise or a file-like object.
+
+        Strings of any length are split into records without copying.
+        A DataPromise's chunks, or a file's contents, are framed lazily
+        as the connection is ready for them; the file is closed once it
+        has been sent.
+        """
         if isinstance(data, DataPromise):
-            self._rq.send_record(self._type, data=data)            
+            self._rq.send_stream(self._type, iter(data))
+        elif hasattr(data, 'read'):
+            self._rq.send_stream(self._type, _read_blocks(data))
         elif data:
-            if len(data) > 65536:
-                for i in xrange((len(data) / 65535)+1):
-                    self._rq.send_record(self._type,
-                                         data=data[i*65535:(i+1)*65535])
-            else:                    
-                self._rq.send_record(self._type,
-                                     data=data)
+            self._rq.send_record(self._type,
+                                 data=data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
 
     def close(self):
         if not self._closed:
@@ -555,16 +1039,156 @@ class RecordOutputStream(object):
                                  data='')
             
 
+class StreamingInput(object):
+    """A request's stdin, readable while FCGI_STDIN records still arrive.
+
+    The connection feed()s it each record's data and finish()es it at the
+    end of the stream; reads (in a Dispatcher thread) wait for whatever
+    they need. Unread data is held in memory, but only so much: while
+    pending (the bytes fed and not yet taken by a read) is at least
+    high_water, full is True and the connection stops reading; on_drain
+    is called (from the reading thread) when a read brings it back under.
+    """
+
+    def __init__(self, high_water=None, on_drain=None):
+        self._cond = Condition()
+        self._chunks = deque()
+        self._buf = ''
+        self._eof = False
+        self.high_water = high_water
+        self.on_drain = on_drain
+        self.pending = 0
+
+    def _get_full(self):
+        return self.high_water is not None and self.pending >= self.high_water
+    full = property(_get_full, doc="True while the connection should wait "
+                                   "for the app to read.")
+
+    def feed(self, data):
+        self._cond.acquire()
+        try:
+            self._chunks.append(data)
+            self.pending += len(data)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def finish(self):
+        self._cond.acquire()
+        try:
+            self._eof = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _next_chunk(self):
+        # with _cond held; None at the end of the stream
+        while not self._chunks:
+            if self._eof:
+                return None
+            self._cond.wait()
+        chunk = self._chunks.popleft()
+        full = self.full
+        self.pending -= len(chunk)
+        if full and not self.full and self.on_drain is not None:
+            self.on_drain()
+        return chunk
+
+    def read(self, size=-1):
+        self._cond.acquire()
+        try:
+            pieces = [self._buf]
+            have = len(self._buf)
+            while size < 0 or have < size:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                pieces.append(chunk)
+                have += len(chunk)
+            data = ''.join(pieces)
+            if 0 <= size < len(data):
+                self._buf = data[size:]
+                data = data[:size]
+            else:
+                self._buf = ''
+            return data
+        finally:
+            self._cond.release()
+
+    def readline(self, size=-1):
+        self._cond.acquire()
+        try:
+            pieces = [self._buf]
+            have = len(self._buf)
+            found = self._buf.find('\n')
+            while found < 0 and (size < 0 or have < size):
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                found = chunk.find('\n')
+                if found >= 0:
+                    found += have
+                pieces.append(chunk)
+                have += len(chunk)
+            data = ''.join(pieces)
+            end = len(data)
+            if found >= 0:
+                end = found + 1
+            if 0 <= size < end:
+                end = size
+            self._buf = data[end:]
+            return data[:end]
+        finally:
+            self._cond.release()
+
+    def readlines(self, sizehint=0):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.finish()
+
 class Request(object):
+    # Set (by the Connection) when the request runs on a Dispatcher thread;
+    # its output is then handed to the asyncore thread.
+    dispatcher = None
+    running = False
+    aborted = False
+
     def __init__(self, conn, request_id, beginRequestBody):
         self._conn = conn
         self.request_id = request_id
         self.keepConnection = beginRequestBody.shouldKeepConn
-        self.stdin = StringIO()
+        self.streaming = conn.stream_stdin and conn.dispatcher is not None
+        if self.streaming:
+            # Buffer no more of the body in memory than a spooled one would.
+            self.stdin = StreamingInput(conn.spool_size,
+                                        conn.dispatcher.wakeup)
+        else:
+            self.stdin = SpooledTemporaryFile(max_size=conn.spool_size)
         self.environ = {}
         self.stdout = RecordOutputStream(self, FCGI_STDOUT)
         self.stderr = RecordOutputStream(self, FCGI_STDERR)
         self.__ended = False
+        self._params = []
         self._paramsDone = False
         self._stdinDone = False
         
@@ -572,31 +1196,75 @@ class Request(object):
         for [name, val] in params:
             self.environ[name] = val
 
+    def add_params_data(self, data):
+        # Pairs may straddle records, so decode them all at the end.
+        self._params.append(data)
+
     def send_record(self, type, **kw):
-        self._conn.send_record(type, self.request_id, **kw)
+        if self.dispatcher is None:
+            self._conn.send_record(type, self.request_id, **kw)
+        else:
+            self.dispatcher.call(self._conn.send_record, type,
+                                 self.request_id, **kw)
+
+    def send_stream(self, type, chunks):
+        if self.dispatcher is None:
+            self._conn.send_stream(type, self.request_id, chunks)
+        else:
+            self.dispatcher.call(self._conn.send_stream, type,
+                                 self.request_id, chunks)
         
     def finish_params(self):
-        if self._stdinDone:
+        if self._params:
+            params, self._params = self._params, None
+            if len(params) == 1:
+                decode_params(params[0], self.environ)
+            else:
+                decode_params(''.join(params), self.environ)
+        if self._stdinDone or self.streaming:
             self._conn.execute_request(self)
-        else:
-            self._paramsDone = True
+        self._paramsDone = True
 
     def add_stdin(self, data):
-        self.stdin.write(data)
+        if self.streaming:
+            self.stdin.feed(data)
+        else:
+            self.stdin.write(data)
 
     def finish_stdin(self):
-        self.stdin.seek(0, 0)
-        if self._paramsDone:
-            self._conn.execute_request(self)
+        if self.streaming:
+            self.stdin.finish()
         else:
-            self._stdinDone = True
+            self.stdin.seek(0, 0)
+            if self._paramsDone:
+                self._conn.execute_request(self)
+        self._stdinDone = True
+
+    def abandon(self):
+        """The connection is gone; don't keep a reader waiting for stdin."""
+        self.aborted = True
+        if self.streaming:
+            self.stdin.finish()
 
     def abort(self):
-        self.end()
+        self.abandon()
+        if not self.running:
+            # Otherwise it ends when run_request() returns.
+            self.end()
 
     def end(self, code=0):
+        """Finish the response (from any thread)."""
+        if self.dispatcher is None:
+            self._end(code)
+        else:
+            self.dispatcher.call(self._end, code)
+
+    def _end(self, code):
         if self.__ended:
             return
+        # On the asyncore thread from here on: send directly, so that
+        # everything is buffered before the connection may be closed.
+        self.dispatcher = None
         self.stdout.close()
         self.send_record(FCGI_END_REQUEST,
                          rb=EndRequestBody(appStatus=code,
@@ -605,6 +1273,8 @@ class Request(object):
         if not self.keepConnection:
             self._conn.flush_close()
         del self._conn
+        # (removes the temporary file, if the body was spooled to one)
+        self.stdin.close()
         del self.stdin
         del self.environ
         self.__ended = True
@@ -614,16 +1284,382 @@ def check_address(address):
     return True
 
 class Server(RecordConnection):
+    """Accepts FastCGI connections.
+
+    threads: the number of threads to run requests on (0 runs them on the
+        asyncore thread, one at a time).
+    max_requests: the most requests to run or queue at once.
+    """
     _start_connection = Connection
 
     accepting = True
+    threads = 10
+    max_requests = 50
+    dispatcher = None
+    # Set TCP_NODELAY on TCP connections: responses are written whole, so
+    # there is nothing for Nagle's algorithm to coalesce, only delays.
+    nodelay = True
+
+    def __init__(self, sock=None, map=None, threads=None, max_requests=None):
+        RecordConnection.__init__(self, sock=sock, map=map)
+        if threads is not None:
+            self.threads = threads
+        if max_requests is not None:
+            self.max_requests = max_requests
+        if self.threads:
+            self.dispatcher = Dispatcher(self.threads, self.max_requests,
+                                         map)
 
     def handle_accept(self):
-        (newsock, addr) = self.accept()
+        pair = self.accept()
+        if pair is None:
+            return
+        (newsock, addr) = pair
         if not check_address(addr):
             newsock.close()
             return
-        self._start_connection(sock=newsock)
+        if self.nodelay and newsock.family != socket.AF_UNIX:
+            try:
+                newsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error:
+                pass
+        conn = self._start_connection(sock=newsock, map=self._map)
+        conn.dispatcher = self.dispatcher
+
+class WSGIConnection(Connection):
+    """A FastCGI connection answering each request with a WSGI app.
+
+    The app is chosen from gateway.mounts by SCRIPT_NAME + PATH_INFO (or
+    the path of REQUEST_URI, if the web server sends neither), and
+    SCRIPT_NAME and PATH_INFO are set from the mount point as
+    CherryPyWSGIServer would. The params are the environ; nothing is
+    re-parsed.
+    """
+    gateway = None
+
+    def run_request(self, request):
+        # (approximate: several threads may count at once)
+        self.gateway.requests_served += 1
+        environ = request.environ
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if not path:
+            path = unquote(environ.get('REQUEST_URI', '').split('?', 1)[0])
+        mount = self.gateway.mounts.match(path)
+        if mount is None:
+            request.stdout.write('Status: 404 Not Found\r\n'
+                                 'Content-Type: text/plain\r\n\r\n'
+                                 'Not Found')
+            return
+        mount_point, app = mount
+        environ['SCRIPT_NAME'] = mount_point
+        environ['PATH_INFO'] = path[len(mount_point):]
+        if environ.get('HTTPS', 'off').lower() in ('on', '1'):
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        environ.update({'wsgi.version': (1, 0),
+                        'wsgi.url_scheme': scheme,
+                        'wsgi.input': request.stdin,
+                        'wsgi.errors': request.stderr,
+                        'wsgi.multithread': self.dispatcher is not None,
+                        'wsgi.multiprocess': self.gateway.multiprocess,
+                        'wsgi.run_once': False,
+                        'wsgi.file_wrapper': FileWrapper})
+
+        stdout = request.stdout
+        response = []
+        request.headers_sent = False
+
+        def write(data):
+            if not request.headers_sent:
+                if not response:
+                    raise AssertionError("write() before start_response()")
+                status, headers = response
+                head = ['Status: %s\r\n' % status]
+                for header in headers:
+                    head.append('%s: %s\r\n' % header)
+                head.append('\r\n')
+                if len(data) < 16384:
+                    # Send the head in the same record as a small body.
+                    head.append(data)
+                    data = ''
+                request.headers_sent = True
+                stdout.write(''.join(head))
+            if data:
+                stdout.write(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if request.headers_sent:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif response:
+                raise AssertionError("Headers already set!")
+            response[:] = [status, headers]
+            return write
+
+        result = app(environ, start_response)
+        if isinstance(result, FileWrapper) and hasattr(result.filelike, 'read'):
+            # The file is read (and closed) as the connection takes it.
+            write('')
+            stdout.write(result.filelike)
+            return
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+            if not request.headers_sent:
+                write('')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def handle_traceback(self, request, exc_info):
+        LOG.error('Error in request %d.%d', self.id, request.request_id,
+                  exc_info=exc_info)
+        if not getattr(request, 'headers_sent', False):
+            request.stdout.write('Status: 500 Internal Server Error\r\n'
+                                 'Content-Type: text/plain\r\n\r\n'
+                                 'Internal Server Error')
+
+
+class WSGIServer(object):
+    """Serves WSGI applications over FastCGI (e.g. behind nginx's
+    fastcgi_pass), with the same mount points as CherryPyWSGIServer.
+
+    bind_addr: the (host, port) or UNIX socket path to listen on, or None
+        for the socket the web server passed as FCGI_LISTENSOCK_FILENO.
+    wsgi_app: a WSGI application, or a list of (mount_point, wsgi_app)
+        pairs; apps can be mounted and unmounted while running with
+        add_mount/remove_mount.
+    threads: the number of threads requests run on (default 10; 0 runs
+        them one at a time on the event loop).
+    max_requests: the most requests admitted at once (FCGI_MAX_REQS).
+    request_queue_size: the listen() backlog.
+
+    spool_size and stream_stdin are passed on to each WSGIConnection;
+    set multiprocess if other processes serve the same socket.
+
+    recycle_requests, recycle_rss: if non-zero, once this process has
+    served that many requests, or its memory usage exceeds that many bytes,
+    the server stops accepting and start() returns when the requests in
+    hand are done and their responses sent, or after drain_timeout seconds
+    (so a ProcessManager can replace the worker).
+    """
+
+    ConnectionClass = WSGIConnection
+    socket = None
+    server = None
+    ready = False
+    multiprocess = False
+    spool_size = Connection.spool_size
+    stream_stdin = False
+    # seconds between checks of the ready flag
+    poll_timeout = 1.0
+    recycle_requests = 0
+    recycle_rss = 0
+    rss_check_interval = 10.0
+    drain_timeout = 30.0
+    retiring = False
+    # Set by ProcessManager: where to report this worker's state.
+    scoreboard = None
+    slot = None
+
+    def __init__(self, bind_addr, wsgi_app, threads=10, max_requests=50,
+                 request_queue_size=128):
+        if callable(wsgi_app):
+            self.mounts = MountTable([('', wsgi_app)])
+        else:
+            self.mounts = MountTable(wsgi_app)
+        self.bind_addr = bind_addr
+        self.threads = threads
+        self.max_requests = max_requests
+        self.request_queue_size = request_queue_size
+        self.map = {}
+        self.requests_served = 0
+        self._state = None
+        self._next_rss_check = 0
+        self._drain_deadline = None
+
+    def add_mount(self, mount_point, wsgi_app):
+        self.mounts.add(mount_point, wsgi_app)
+
+    def remove_mount(self, mount_point):
+        self.mounts.remove(mount_point)
+
+    def listen(self):
+        """Create, bind and listen on the socket (start() calls this if
+        there is no socket yet)."""
+        if self.bind_addr is None:
+            self.socket = inherited_listener()
+            if self.socket is None:
+                raise ValueError('No bind_addr, and stdin is not a '
+                                 'listening socket.')
+            return
+        if isinstance(self.bind_addr, basestring):
+            try:
+                os.unlink(self.bind_addr)
+            except OSError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            host, port = self.bind_addr
+            family = socket.getaddrinfo(host or None, port, socket.AF_UNSPEC,
+                                        socket.SOCK_STREAM, 0,
+                                        socket.AI_PASSIVE)[0][0]
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.bind_addr)
+        sock.listen(self.request_queue_size)
+        self.socket = sock
+
+    def _start_connection(self, sock, map):
+        conn = self.ConnectionClass(sock=sock, map=map)
+        conn.gateway = self
+        conn.spool_size = self.spool_size
+        conn.stream_stdin = self.stream_stdin
+        return conn
+
+    def start(self):
+        """Serve until stop() is called."""
+        if self.socket is None:
+            self.listen()
+        self.server = Server(sock=self.socket, map=self.map,
+                             threads=self.threads,
+                             max_requests=self.max_requests)
+        self.server._start_connection = self._start_connection
+        self.ready = True
+        self.retiring = False
+        try:
+            while self.ready:
+                asyncore.loop(self.poll_timeout, True, self.map, 1)
+                self.maintain()
+        finally:
+            self.ready = False
+            # Abandon the requests still pending, so that no worker is left
+            # waiting for stdin when the workers are joined.
+            for channel in self.map.values():
+                if isinstance(channel, Connection):
+                    channel.handle_close()
+            if self.server.dispatcher is not None:
+                self.server.dispatcher.stop()
+            for channel in self.map.values():
+                if channel is not self.server:
+                    channel.close()
+            self.map.clear()
+            self.server = None
+
+    def stop(self):
+        """Stop serving (from any thread, or a signal handler)."""
+        self.ready = False
+        server = self.server
+        if server is not None and server.dispatcher is not None:
+            server.dispatcher.wakeup()
+
+    def maintain(self):
+        """Report our state to the scoreboard, and retire if it's time."""
+        dispatcher = self.server.dispatcher
+        active = dispatcher is not None and dispatcher.active or 0
+        if self.scoreboard is not None:
+            if not active:
+                state = IDLE
+            elif active >= self.threads:
+                state = FULL
+            else:
+                state = ACTIVE
+            if state != self._state:
+                self._state = state
+                self.scoreboard.set(self.slot, state)
+
+        if self.retiring:
+            # Requests release their admission as soon as their response
+            # is queued; wait until it has been sent, too.
+            if not active and (self._drain() or
+                               time.time() > self._drain_deadline):
+                self.ready = False
+            return
+        if (self.recycle_requests and
+                self.requests_served >= self.recycle_requests):
+            self.retire('served %d requests' % self.requests_served)
+        elif self.recycle_rss and time.time() >= self._next_rss_check:
+            self._next_rss_check = time.time() + self.rss_check_interval
+            usage = memory_usage()
+            if usage > self.recycle_rss:
+                self.retire('using %d bytes' % usage)
+
+    def retire(self, reason):
+        """Stop accepting connections; stop once the requests in hand end."""
+        LOG.info('Retiring worker %d: %s', os.getpid(), reason)
+        self.retiring = True
+        self._drain_deadline = time.time() + self.drain_timeout
+        # Leave the socket open for the other workers.
+        self.server.del_channel()
+
+    def _drain(self):
+        """Close each connection once its output is sent; return True when
+        none has output left to send."""
+        drained = True
+        for channel in self.map.values():
+            if isinstance(channel, Connection):
+                if channel.writable():
+                    drained = False
+                channel.flush_close()
+        return drained
+
+
+class ProcessManager(object):
+    """Runs a WSGIServer in a pool of forked worker processes.
+
+    The parent opens the server's socket (or takes the one the web server
+    passed as FCGI_LISTENSOCK_FILENO, if server.bind_addr is None) and
+    supervises the workers with a Prefork: each runs the server's event
+    loop and thread pool on the shared socket. Workers are replaced when
+    they retire (see WSGIServer.recycle_requests/recycle_rss) or die, and
+    their number scales between min_workers and max_workers with how many
+    are FULL.
+
+    SIGTERM or SIGINT stop the workers and return from run(); SIGHUP
+    replaces them one at a time.
+    """
+
+    def __init__(self, server, min_workers=2, max_workers=None):
+        self.server = server
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers or min_workers, min_workers)
+        self.prefork = None
+
+    def run(self):
+        server = self.server
+        if server.socket is None:
+            server.listen()
+        server.multiprocess = True
+        prefork = Prefork(self._serve, self.min_workers)
+        prefork.min_workers = self.min_workers
+        prefork.max_workers = self.max_workers
+        prefork.scoreboard = Scoreboard(self.max_workers + 1)
+        self.prefork = prefork
+        def stop(signum, frame):
+            prefork.stop()
+        def restart(signum, frame):
+            prefork.restart()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, restart)
+        prefork.run()
+
+    def _serve(self):
+        # In a worker
+        server = self.server
+        def stop(signum, frame):
+            server.stop()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.scoreboard = self.prefork.scoreboard
+        server.slot = self.prefork.slot
+        server.start()
 
 
 if __name__ == '__main__':
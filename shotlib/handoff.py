@@ -0,0 +1,162 @@
+#
+# Hand a listening socket over to a new copy of this process, so that a
+# restart never refuses a connection.
+#
+# The old process forks and execs its own command line, with the socket's
+# file descriptor (and the write end of a pipe) named in the environment.
+# The new process picks the socket up with inherited_socket() instead of
+# binding its own, and calls ready() once it is serving; only then does the
+# old process stop accepting, finish the requests it has in hand and exit.
+# If the new process dies before it is ready, the old one carries on.
+#
+# (Python 2 has no sendmsg(), so the socket can't be passed with
+# SCM_RIGHTS to an unrelated process; it is inherited across fork/exec.)
+#
+
+import os
+import sys
+import errno
+import select
+import socket
+import logging
+import threading
+
+LOG = logging.getLogger('shotlib.handoff')
+
+LISTEN_FD = 'SHOTLIB_LISTEN_FD'
+LISTEN_FAMILY = 'SHOTLIB_LISTEN_FAMILY'
+READY_FD = 'SHOTLIB_READY_FD'
+
+try:
+    MAXFD = os.sysconf('SC_OPEN_MAX')
+except:
+    MAXFD = 256
+
+def handed_over():
+    """Return True if this process was started by Handoff."""
+    return READY_FD in os.environ
+
+def inherited_socket():
+    """Return the listening socket handed to this process, or None."""
+    fd = os.environ.pop(LISTEN_FD, None)
+    family = os.environ.pop(LISTEN_FAMILY, None)
+    if fd is None:
+        return None
+    fd = int(fd)
+    sock = socket.fromfd(fd, int(family or socket.AF_INET),
+                         socket.SOCK_STREAM)
+    # fromfd() dup()s the descriptor
+    os.close(fd)
+    LOG.info('Inherited listening socket %s', sock.getsockname())
+    return sock
+
+def ready():
+    """Tell the process which started this one that it is now serving."""
+    fd = os.environ.pop(READY_FD, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), 'ready')
+        os.close(int(fd))
+    except OSError:
+        LOG.warn('Unable to tell the old process we are ready', exc_info=True)
+
+class Handoff(object):
+    """Starts a successor process and waits for it to become ready.
+
+    sock: the listening socket to pass on, or None (e.g. if every process
+        binds its own with SO_REUSEPORT).
+    on_ready: called (from a background thread) once the successor is
+        serving; it should make this process stop accepting, drain and
+        exit.
+    argv: the command line to run with sys.executable (default sys.argv).
+    cwd: the directory to run it in (default the current one); a daemon
+        should pass the directory it was started from.
+    timeout: seconds to wait for the successor before giving up on it.
+    """
+
+    timeout = 60
+
+    def __init__(self, sock, on_ready, argv=None, cwd=None):
+        self.sock = sock
+        self.on_ready = on_ready
+        self.argv = argv or sys.argv
+        self.cwd = cwd
+        self.pid = None
+
+    def _get_pending(self):
+        return self.pid is not None
+    pending = property(_get_pending,
+                       doc="True while waiting for a successor to start.")
+
+    def start(self):
+        """Fork and exec the successor; returns its pid."""
+        r, w = os.pipe()
+        env = dict(os.environ)
+        env[READY_FD] = str(w)
+        keep = [w]
+        if self.sock is not None:
+            fd = self.sock.fileno()
+            env[LISTEN_FD] = str(fd)
+            env[LISTEN_FAMILY] = str(self.sock.family)
+            keep.append(fd)
+
+        pid = os.fork()
+        if not pid:
+            # In the child: nothing but the listening socket, the ready
+            # pipe and stdio may stay open, or connections the old process
+            # closes would live on in this one.
+            try:
+                fd = 3
+                for k in sorted(keep):
+                    if k >= fd:
+                        os.closerange(fd, k)
+                        fd = k + 1
+                os.closerange(fd, MAXFD)
+                if self.cwd:
+                    os.chdir(self.cwd)
+                os.execve(sys.executable, [sys.executable] + list(self.argv),
+                          env)
+            finally:
+                os._exit(127)
+
+        os.close(w)
+        self.pid = pid
+        LOG.info('Started successor %d', pid)
+        thread = threading.Thread(target=self._wait, args=(r, pid),
+                                  name='Handoff %d' % pid)
+        thread.setDaemon(True)
+        thread.start()
+        return pid
+
+    def _wait(self, r, pid):
+        data = ''
+        try:
+            try:
+                while True:
+                    try:
+                        readable = select.select([r], [], [], self.timeout)[0]
+                    except select.error, e:
+                        if e.args[0] == errno.EINTR:
+                            continue
+                        raise
+                    if readable:
+                        data = os.read(r, 16)
+                    break
+            finally:
+                os.close(r)
+        except:
+            LOG.error('Waiting for successor %d failed', pid, exc_info=True)
+
+        # Reap it (or, for a daemon, its first fork) if it has exited.
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            pass
+
+        self.pid = None
+        if data:
+            LOG.info('Successor %d is ready; handing over', pid)
+            self.on_ready()
+        else:
+            LOG.error('Successor %d did not start; carrying on', pid)
@@ -1,17 +1,28 @@
 from shotlib.service import Service
 from shotlib import wsgiserver
+from shotlib import asyncwsgi
+from shotlib.prefork import Prefork
+from shotlib import handoff
+import signal
+import logging
 from optparse import OptionParser, OptionGroup
 from urlparse import urlparse
 import shotweb
 
+LOG = logging.getLogger('shotlib.httpservice')
+
 class ShutdownException(Exception):
     pass
 
 class HttpService(Service):
+    supports_handoff = True
     external_uri = None
     server = None
+    prefork = None
+    handoff = None
     default_host = "0.0.0.0"
     default_port = 8080
+    default_workers = 1
     def option_parser(self):
         parser = super(HttpService, self).option_parser()
         group = OptionGroup(parser, "HTTP Options", "HTTP Server Options")
@@ -19,6 +30,17 @@ class HttpService(Service):
                          dest="host")
         group.add_option("-p", "--port", action="store", default=self.default_port, type="int")
         group.add_option("--external", action="store", default=self.external_uri, dest="external_uri")
+        group.add_option("--workers", action="store", default=self.default_workers, type="int",
+                         dest="workers",
+                         help="Number of server processes to fork (default: %d)" % self.default_workers)
+        group.add_option("--reuse-port", action="store_true", default=False, dest="reuse_port",
+                         help="With --workers, bind each worker's socket with SO_REUSEPORT instead of sharing one socket")
+        group.add_option("--event-loop", action="store_true", default=False, dest="event_loop",
+                         help="Serve with AsyncWSGIServer: one event loop does all socket I/O and threads only run the app")
+        group.add_option("--memory-stats", action="store_true", default=False, dest="memory_stats",
+                         help="Count live connections, requests and buffered bytes, watch for leaks, and log a memory report on SIGUSR1")
+        group.add_option("--tracemalloc", action="store", default=0, type="int", dest="tracemalloc",
+                         help="With --memory-stats, trace allocations with tracemalloc (if available), keeping this many frames")
         parser.add_option_group(group)
         return parser
 
@@ -26,7 +48,9 @@ class HttpService(Service):
         pass
 
     def shutdown(self):
-        if self.server:
+        if self.prefork:
+            self.prefork.stop()
+        elif self.server:
             self.server.interrupt = ShutdownException()
         else:
             self.quit = True
@@ -34,9 +58,53 @@ class HttpService(Service):
     def signal_term(self, signum, frame):
         self.shutdown()
 
+    def signal_hup(self, signum, frame):
+        if self.prefork:
+            self.prefork.restart()
+
     def signal_int(self, signum, frame):
         self.shutdown()
 
+    def signal_usr1(self, signum, frame):
+        if self.prefork:
+            # The parent serves nothing; pass it on to the workers.
+            for pid in self.prefork.children.keys():
+                self.prefork.signal(pid, signal.SIGUSR1)
+        else:
+            self.dump_memory()
+
+    def signal_usr2(self, signum, frame):
+        self.hand_off()
+
+    def dump_memory(self, lines=None):
+        """Log a memory report (see wsgiserver.MemoryStats.dump)."""
+        memory = self.server and self.server.memory_collector
+        if lines is None:
+            if memory is None:
+                LOG.info('Memory report requested, but --memory-stats is off')
+                return
+            lines = memory.dump()
+        for line in lines:
+            LOG.info('memory: %s', line)
+
+    def leak_suspected(self, lines):
+        LOG.warn('Memory has grown steadily; a leak is suspected')
+        self.dump_memory(lines)
+
+    def hand_off(self):
+        """Start a new copy of this service on our socket, then drain and exit."""
+        if self.server is None or (self.prefork is None and
+                                   self.options.workers > 1):
+            # Not started yet, or a prefork worker: only the parent hands off
+            return
+        if self.handoff is not None and self.handoff.pending:
+            LOG.warn('Already handing off to process %d', self.handoff.pid)
+            return
+        self.handoff = handoff.Handoff(self.server.socket, self.shutdown,
+                                       argv=getattr(self, 'argv', None),
+                                       cwd=getattr(self, 'cwd', None))
+        self.handoff.start()
+
     @property
     def server_name(self):
         if self.external_uri:            
@@ -54,13 +122,44 @@ class HttpService(Service):
         
         if self.external_uri:
             app = shotweb.proxy_root_middleware(self.external_uri)(app)
-        server = wsgiserver.CherryPyWSGIServer((self.options.host,
-                                                self.options.port),
-                                               app,
-                                               server_name=self.server_name)
+        if self.options.event_loop:
+            server_class = asyncwsgi.AsyncWSGIServer
+        else:
+            server_class = wsgiserver.CherryPyWSGIServer
+        server = server_class((self.options.host, self.options.port),
+                              app,
+                              server_name=self.server_name)
+        if self.options.memory_stats:
+            server.memory_collector = wsgiserver.MemoryStats(
+                trace=self.options.tracemalloc)
+            server.memory_collector.on_leak = self.leak_suspected
         if self.quit:
             return
 
+        # Take over the socket of the process we are replacing, if any.
+        server.socket = handoff.inherited_socket()
+        self.server = server
+
+        if self.options.workers > 1:
+            server.multiprocess = True
+            if self.options.reuse_port:
+                server.reuse_port = True
+            elif server.socket is None:
+                # Open the socket here; every worker inherits it.
+                server.listen()
+            self.prefork = Prefork(lambda: self.serve(server),
+                                   self.options.workers)
+            handoff.ready()
+            self.prefork.run()
+        else:
+            if server.socket is None:
+                server.listen()
+            handoff.ready()
+            self.serve(server)
+
+    def serve(self, server):
+        # In a forked worker, signals are for this process's server.
+        self.prefork = None
         self.server = server
         try:
             server.start()
@@ -0,0 +1,263 @@
+#
+# Run a server in several forked worker processes, supervised by the parent.
+#
+# The parent opens the listening socket (or the workers each bind their own
+# with SO_REUSEPORT), forks the workers and then only watches them: workers
+# which die are replaced, SIGTERM is passed on to every worker, and a
+# restart() replaces the workers one at a time so something is always
+# accepting connections.
+#
+# With a Scoreboard, the number of workers also follows the load: workers
+# report how busy they are, and the parent adds workers (up to max_workers)
+# while all of them are full and retires idle ones (down to min_workers).
+#
+
+import os
+import mmap
+import signal
+import errno
+import time
+import logging
+
+LOG = logging.getLogger('shotlib.prefork')
+
+# Worker states on a Scoreboard
+IDLE = 0     # no requests in hand
+ACTIVE = 1   # some
+FULL = 2     # as many as it can take
+
+class Scoreboard(object):
+    """One state byte per worker slot, in memory shared across fork().
+
+    The parent creates it before forking; each worker set()s its own slot
+    and the parent reads them all.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._map = mmap.mmap(-1, size)
+
+    def set(self, slot, state):
+        self._map[slot] = chr(state)
+
+    def get(self, slot):
+        return ord(self._map[slot])
+
+class Prefork(object):
+    """Forks and supervises worker processes.
+
+    target: called (with no arguments) in each forked worker; the worker
+        exits when it returns. A worker which exits with status 0 of its
+        own accord (e.g. to be recycled) is "retired" and replaced without
+        counting as a crash.
+    workers: the number of worker processes to keep running.
+
+    scoreboard: a Scoreboard with a slot for each of max_workers, plus one
+        for the extra worker of a rolling restart; set it (and
+        min_workers/max_workers) to scale with the load. Each worker finds
+        its slot number in self.slot.
+    """
+
+    # seconds between checks on the workers
+    interval = 0.5
+    # a worker which exits sooner than this after starting is "crashing"...
+    min_lifetime = 1.0
+    # ...and isn't replaced for this many seconds, so we don't fork-bomb
+    restart_delay = 5.0
+    # seconds workers get to exit after SIGTERM before they are SIGKILLed
+    stop_timeout = 30.0
+    # With a scoreboard: the range the number of workers may scale over...
+    min_workers = None
+    max_workers = None
+    # ...and how long there must be more than one idle worker before one
+    # is retired.
+    scale_down_delay = 10.0
+    scoreboard = None
+    slot = None
+
+    def __init__(self, target, workers):
+        self.target = target
+        self.workers = workers
+        self.quit = False
+        self.generation = 0
+        # pid -> (generation, start time)
+        self.children = {}
+        # pid -> time SIGTERM was sent
+        self.stopping = {}
+        # pid -> scoreboard slot
+        self.slots = {}
+        self._next_spawn = 0
+        self._idle_since = None
+
+    def _free_slot(self):
+        used = set(self.slots.values())
+        for slot in xrange(self.scoreboard.size):
+            if slot not in used:
+                return slot
+        return None
+
+    def spawn(self):
+        slot = None
+        if self.scoreboard is not None:
+            slot = self._free_slot()
+            if slot is None:
+                LOG.warn('No free scoreboard slot; not starting a worker')
+                return None
+            self.scoreboard.set(slot, IDLE)
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (self.generation, time.time())
+            if slot is not None:
+                self.slots[pid] = slot
+            LOG.info('Started worker %d', pid)
+            return pid
+        # In the worker
+        status = 1
+        try:
+            self.children = {}
+            self.stopping = {}
+            self.slots = {}
+            self.slot = slot
+            self.target()
+            status = 0
+        except:
+            LOG.error('Worker %d failed', os.getpid(), exc_info=True)
+        os._exit(status)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """Collect exited workers; return how many exited unexpectedly."""
+        crashed = 0
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if not pid:
+                break
+            generation, started = self.children.pop(pid, (None, None))
+            if started is None:
+                continue
+            slot = self.slots.pop(pid, None)
+            if slot is not None:
+                self.scoreboard.set(slot, IDLE)
+            if self.stopping.pop(pid, None) is not None:
+                LOG.info('Worker %d stopped', pid)
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                LOG.info('Worker %d retired', pid)
+                continue
+            LOG.warn('Worker %d exited unexpectedly (status %d)', pid, status)
+            if time.time() - started < self.min_lifetime:
+                crashed += 1
+        return crashed
+
+    def stop_worker(self, pid):
+        self.stopping[pid] = time.time()
+        self.signal(pid, signal.SIGTERM)
+
+    def restart(self):
+        """Replace every worker, one at a time (e.g. on SIGHUP)."""
+        self.generation += 1
+
+    def stop(self):
+        """Ask run() to stop all workers and return (e.g. on SIGTERM)."""
+        self.quit = True
+
+    def _running(self):
+        return [pid for pid in self.children if pid not in self.stopping]
+
+    def scale(self, now):
+        """Adjust the number of workers to the load on the scoreboard."""
+        running = self._running()
+        if not running or len(running) < self.workers:
+            return
+        states = [self.scoreboard.get(self.slots[pid]) for pid in running]
+        idle = [pid for pid, state in zip(running, states) if state == IDLE]
+        if len(idle) > 1 and self.workers > self.min_workers:
+            if self._idle_since is None:
+                self._idle_since = now
+            elif now - self._idle_since >= self.scale_down_delay:
+                self._idle_since = None
+                self.workers -= 1
+                LOG.info('Scaling down to %d workers', self.workers)
+                self.stop_worker(idle[-1])
+            return
+        self._idle_since = None
+        if states.count(FULL) == len(running) and \
+               self.workers < self.max_workers:
+            self.workers += 1
+            LOG.info('All workers busy; scaling up to %d', self.workers)
+
+    def check(self):
+        now = time.time()
+        if self.reap():
+            self._next_spawn = now + self.restart_delay
+            LOG.error('Workers are crashing; waiting %.1fs to replace them',
+                      self.restart_delay)
+
+        if self.scoreboard is not None and not self.stopping:
+            self.scale(now)
+
+        running = self._running()
+        if len(running) < self.workers:
+            if now >= self._next_spawn:
+                for i in xrange(self.workers - len(running)):
+                    self.spawn()
+            return
+
+        # Rolling restart: retire one old worker at a time, once its
+        # replacement has been started.
+        if not self.stopping:
+            for pid in running:
+                if self.children[pid][0] != self.generation:
+                    self.spawn()
+                    self.stop_worker(pid)
+                    break
+
+        for pid, sent in self.stopping.items():
+            if now - sent > self.stop_timeout:
+                LOG.warn('Worker %d did not stop; killing it', pid)
+                self.signal(pid, signal.SIGKILL)
+
+    def run(self):
+        """Start the workers and supervise them until stop() is called."""
+        if self.scoreboard is not None:
+            if self.min_workers is None:
+                self.min_workers = self.workers
+            if self.max_workers is None:
+                self.max_workers = self.workers
+            self.max_workers = min(self.max_workers,
+                                   max(self.scoreboard.size - 1, 1))
+        LOG.info('Starting %d workers', self.workers)
+        while not self.quit:
+            self.check()
+            time.sleep(self.interval)
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop every worker, killing those that outlast stop_timeout."""
+        for pid in self._running():
+            self.stop_worker(pid)
+        deadline = time.time() + self.stop_timeout
+        while self.children:
+            self.reap()
+            if not self.children:
+                break
+            if time.time() > deadline:
+                for pid in self.children:
+                    LOG.warn('Worker %d did not stop; killing it', pid)
+                    self.signal(pid, signal.SIGKILL)
+                deadline = time.time() + self.stop_timeout
+            time.sleep(0.1)
+        LOG.info('All workers stopped')
@@ -4,6 +4,7 @@
 #
 
 from shotlib.daemonize import daemonize
+from shotlib import handoff
 from optparse import OptionParser, OptionGroup
 import time
 import errno
@@ -15,6 +16,11 @@ import sys
 LOG = logging.getLogger('Service')
 
 class Service(object):
+    # Set True in services which hand their work over to a new process on
+    # SIGUSR2 (see shotlib.handoff); --action restart then signals the
+    # running process instead of stopping it and starting another.
+    supports_handoff = False
+
     def __init__(self, name='service'):
         self.name = name
         try:
@@ -45,7 +51,7 @@ class Service(object):
                             "Options applicable only to daemon mode")
         group.add_option('-a', '--action',
                          action='store', default='start', dest='action',
-                         help='Specifies daemon action (start/stop)')
+                         help='Specifies daemon action (start/stop/restart)')
         group.add_option('--kill', action='store_true', default=False,
                          dest='kill', help='For --action stop, indicates a willingness to use SIGKILL to stop a stubborn process that does not respond to SIGTERM')
                          
@@ -169,14 +175,46 @@ class Service(object):
             else:
                 parser.error('Unable to kill %d, %s', (pid, str(v)))
 
+    def service_restart(self, options, parser):
+        pid = self.get_pid(options, parser)
+        pidfile = os.path.join(options.home, options.pidfile)
+        try:
+            os.kill(pid, signal.SIGUSR2)
+        except os.error, v:
+            if v.errno == errno.EPERM:
+                parser.error('Unable to signal %d, operation not permitted' % pid)
+            elif v.errno == errno.ESRCH:
+                parser.error('Unable to signal %d, no such process' % pid)
+            else:
+                parser.error('Unable to signal %d, %s' % (pid, str(v)))
+        # The successor writes its own pid once it has daemonized
+        for waiting in xrange(int(handoff.Handoff.timeout / .5) + 10):
+            time.sleep(.5)
+            try:
+                newpid = int(open(pidfile).readline().strip())
+            except (IOError, ValueError):
+                continue
+            if newpid != pid:
+                print 'Restarted: %d handed over to %d' % (pid, newpid)
+                return
+        print 'Process %d did not hand over to a new process; it is still running' % pid
+
     def log(self, msg, *args):
         LOG.info(msg, *args)
     
     def main(self):
+        # Remembered so a successor can be started with the same command
+        # line, from the same place, after daemonize() has chdir()ed.
+        self.argv = sys.argv[:]
+        self.cwd = os.getcwd()
         parser = self.option_parser()
         (options, args) = parser.parse_args()
         self.handle_options(options, parser)
         self.handle_args(args, parser)        
+        if handoff.handed_over():
+            # We are the successor: whatever action the old process was
+            # started with, ours is to start.
+            options.action = 'start'
         if options.daemon or options.action != 'start':
             if options.action == 'start':
                 self.daemonize(options)
@@ -184,6 +222,9 @@ class Service(object):
                 self.service_stop(options, parser)
                 return
             elif options.action == 'restart':
+                if self.supports_handoff:
+                    self.service_restart(options, parser)
+                    return
                 self.service_stop(options, parser)
                 self.daemonize(options)
             else:
@@ -197,7 +238,10 @@ class Service(object):
         except:
             LOG.error('Service exiting with error', exc_info=True)
         try:
-            os.remove(os.path.join(self.options.home, self.options.pidfile))
+            pidfile = os.path.join(self.options.home, self.options.pidfile)
+            # After a handoff the pidfile is our successor's
+            if int(open(pidfile).readline().strip()) == os.getpid():
+                os.remove(pidfile)
         except:
             pass
 
@@ -41,12 +41,16 @@ as you want in one instance:
 
 
 import base64
+import bisect
+import heapq
 import Queue
 import os
 import re
 quoted_slash = re.compile("(?i)%2F")
 import rfc822
+import select
 import socket
+import stat
 try:
     import cStringIO as StringIO
 except ImportError:
@@ -55,6 +59,8 @@ import sys
 import threading
 import time
 import traceback
+import zlib
+from collections import OrderedDict
 from urllib import unquote
 from urlparse import urlparse
 
@@ -64,7 +70,25 @@ try:
 except ImportError:
     SSL = None
 
+try:
+    from os import sendfile as _sendfile
+except ImportError:
+    try:
+        # http://code.google.com/p/pysendfile/
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+try:
+    # Python 3.4+, or the pytracemalloc backport for a patched Python 2.
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 import errno
+import fcntl
+import gc
+import weakref
 socket_errors_to_ignore = []
 # Not all of these names will be defined for every platform.
 for _ in ("EPIPE", "ETIMEDOUT", "ECONNREFUSED", "ECONNRESET",
@@ -77,6 +101,14 @@ for _ in ("EPIPE", "ETIMEDOUT", "ECONNREFUSED", "ECONNRESET",
 socket_errors_to_ignore = dict.fromkeys(socket_errors_to_ignore).keys()
 socket_errors_to_ignore.append("timed out")
 
+if hasattr(socket, "SO_REUSEPORT"):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith("linux"):
+    # Linux 3.9+; Python 2's socket module doesn't export it.
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
 comma_separated_headers = ['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
     'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
     'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
@@ -84,6 +116,158 @@ comma_separated_headers = ['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
     'TRAILER', 'TRANSFER-ENCODING', 'UPGRADE', 'VARY', 'VIA', 'WARNING',
     'WWW-AUTHENTICATE']
 
+def _header_key(name):
+    """Return (environ key, comma separated?) for a request header name."""
+    name = name.strip().upper()
+    return "HTTP_" + name.replace("-", "_"), name in comma_separated_headers
+
+# Precomputed _header_key results for common headers, in the spellings
+# clients actually send, so the usual header needs one dict lookup.
+_header_keys = {}
+for _ in ("Accept", "Accept-Charset", "Accept-Encoding", "Accept-Language",
+          "Authorization", "Cache-Control", "Connection", "Content-Length",
+          "Content-Type", "Cookie", "Expect", "Host", "If-Match",
+          "If-Modified-Since", "If-None-Match", "Keep-Alive", "Origin",
+          "Pragma", "Range", "Referer", "TE", "Transfer-Encoding", "Upgrade",
+          "User-Agent", "Via", "X-Forwarded-For", "X-Forwarded-Host",
+          "X-Forwarded-Proto", "X-Real-IP", "X-Requested-With"):
+    for _spelling in (_, _.lower(), _.upper()):
+        _header_keys[_spelling] = _header_key(_)
+del _spelling
+
+_date_cache = (0, "")
+
+def http_date():
+    """Return the current time as an RFC 1123 date for the Date header.
+    
+    The string is formatted at most once a second and shared by every
+    thread; replacing the cached tuple is atomic, so no lock is needed.
+    """
+    global _date_cache
+    now = int(time.time())
+    second, value = _date_cache
+    if second != now:
+        value = rfc822.formatdate(now)
+        _date_cache = (now, value)
+    return value
+
+# "HTTP/1.1 200 OK\r\n" etc., keyed by (protocol, status). Apps send a
+# small set of statuses, but the dict is capped in case one makes up
+# reason phrases.
+_status_lines = {}
+_status_lines_max = 256
+
+def status_line(protocol, status):
+    """Return the Status-Line (with CRLF) for the given response status."""
+    key = (protocol, status)
+    try:
+        return _status_lines[key]
+    except KeyError:
+        line = "%s %s\r\n" % key
+        if len(_status_lines) < _status_lines_max:
+            _status_lines[key] = line
+        return line
+
+def accept_encoding(header):
+    """Return the content-coding ("gzip", "deflate" or "") to respond with.
+    
+    header: the request's Accept-Encoding value. gzip is preferred when the
+    client rates both equally.
+    """
+    if not header:
+        return ""
+    qualities = {}
+    for item in header.split(","):
+        coding, sep, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params[:2].lower() == "q=":
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+    default = qualities.get("*", 0.0)
+    best, best_q = "", 0.0
+    for coding in ("gzip", "deflate"):
+        q = qualities.get(coding, default)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def _compressobj(encoding, level):
+    if encoding == "gzip":
+        # zlib writes the gzip header and trailer itself for wbits > 16.
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        # HTTP's "deflate" is the zlib format, not raw deflate.
+        wbits = zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+# Response headers send_headers() looks for, as a bit each, so one pass
+# over the app's headers finds them all.
+_HAS_CONTENT_LENGTH = 1
+_HAS_CONNECTION = 2
+_HAS_DATE = 4
+_HAS_SERVER = 8
+_response_header_flags = {}
+for _, _flag in (("Content-Length", _HAS_CONTENT_LENGTH),
+                 ("Connection", _HAS_CONNECTION),
+                 ("Date", _HAS_DATE),
+                 ("Server", _HAS_SERVER)):
+    for _spelling in (_, _.lower(), _.upper()):
+        _response_header_flags[_spelling] = _flag
+del _spelling, _flag
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper callable (PEP 333, "Optional Platform-Specific
+    File Handling").
+    
+    Iterating yields blksize blocks read from filelike, as PEP 333
+    requires, but when an application returns one of these for a regular
+    file, HTTPRequest.respond sends it with sendfile() where possible, so
+    the file's bytes are never copied into Python strings.
+    """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+def _sendfile_all(sock, fd, offset, count, timeout):
+    """Send count bytes of file descriptor fd, from offset, to sock."""
+    out = sock.fileno()
+    while count > 0:
+        try:
+            sent = _sendfile(out, fd, offset, count)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EAGAIN:
+                # Sockets with a timeout are non-blocking underneath.
+                r, w, x = select.select([], [out], [], timeout)
+                if not w:
+                    raise socket.timeout("timed out")
+                continue
+            raise socket.error(e.errno, e.strerror)
+        if not sent:
+            # The file was truncated underneath us.
+            break
+        offset += sent
+        count -= sent
+
+
 class HTTPRequest(object):
     """An HTTP Request (and response).
     
@@ -103,19 +287,34 @@ class HTTPRequest(object):
         send_headers.
     """
     
+    # Per-request state starts out as these class attributes, so that a
+    # new HTTPRequest (one per request, pipelined or not) is cheap to make.
+    ready = False
+    started_response = False
+    status = ""
+    sent_headers = False
+    close_connection = False
+    chunked_write = False
+    mount_point = None
+    bytes_written = 0
+    body = None
+    # The response's content-coding once chosen ("" for none), and the
+    # zlib compressobj streaming it.
+    encoding = None
+    encoder = None
+    # The serialized response head, held back by send_headers so
+    # that it goes out in the same send as the first body chunk.
+    _header_buf = None
+    
     def __init__(self, connection):
         self.connection = connection
-        self.rfile = self.connection.rfile
-        self.sendall = self.connection.sendall
+        self.rfile = connection.rfile
+        self.sendall = connection.sendall
+        # WSGI requires a real dict, so this is one (C level) copy of the
+        # connection's template, which holds everything constant across
+        # its requests.
         self.environ = connection.environ.copy()
-        
-        self.ready = False
-        self.started_response = False
-        self.status = ""
         self.outheaders = []
-        self.sent_headers = False
-        self.close_connection = False
-        self.chunked_write = False
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -126,41 +325,73 @@ class HTTPRequest(object):
         # and doesn't need the client to request or acknowledge the close
         # (although your TCP stack might suffer for it: cf Apache's history
         # with FIN_WAIT_2).
-        request_line = self.rfile.readline()
-        if not request_line:
-            # Force self.ready = False so the connection will close.
-            self.ready = False
-            return
-        
-        if request_line == "\r\n":
-            # RFC 2616 sec 4.1: "...if the server is reading the protocol
-            # stream at the beginning of a message and receives a CRLF
-            # first, it should ignore the CRLF."
-            # But only ignore one leading line! else we enable a DoS.
+        header_lines = None
+        if isinstance(self.rfile, SocketReader):
+            # Fast path: take the whole head out of the read buffer at once.
+            try:
+                head = self.rfile.read_head(
+                    self.connection.server.max_request_header_size)
+            except ValueError, ex:
+                self.close_connection = True
+                self.simple_response("400 Bad Request", repr(ex.args))
+                return
+            if head[:2] == "\r\n":
+                # See RFC 2616 sec 4.1, below.
+                head = head[2:]
+            if not head:
+                self.ready = False
+                return
+            header_lines = head.split("\r\n")
+            # Drop the request line and the two empty strings after the
+            # final CRLF CRLF.
+            request_line = header_lines[0]
+            del header_lines[0]
+            del header_lines[-2:]
+        else:
             request_line = self.rfile.readline()
             if not request_line:
+                # Force self.ready = False so the connection will close.
                 self.ready = False
                 return
+            
+            if request_line == "\r\n":
+                # RFC 2616 sec 4.1: "...if the server is reading the protocol
+                # stream at the beginning of a message and receives a CRLF
+                # first, it should ignore the CRLF."
+                # But only ignore one leading line! else we enable a DoS.
+                request_line = self.rfile.readline()
+                if not request_line:
+                    self.ready = False
+                    return
         
         server = self.connection.server
         environ = self.environ
-        environ["SERVER_SOFTWARE"] = "%s WSGI Server" % server.version
-        
-        method, path, req_protocol = request_line.strip().split(" ", 2)
-        environ["REQUEST_METHOD"] = method
         
-        # path may be an abs_path (including "http://host.domain.tld");
-        scheme, location, path, params, qs, frag = urlparse(path)
-        
-        if frag:
-            self.simple_response("400 Bad Request",
-                                 "Illegal #fragment in Request-URI.")
+        try:
+            method, uri, req_protocol = request_line.strip().split(" ", 2)
+        except ValueError:
+            self.simple_response("400 Bad Request", "Malformed Request-Line")
             return
+        environ["REQUEST_METHOD"] = method
         
-        if scheme:
-            environ["wsgi.url_scheme"] = scheme
-        if params:
-            path = path + ";" + params
+        if uri[:1] == "/" and "#" not in uri:
+            # An abs_path, which is nearly every request: urlparse would
+            # split off ";params" only for us to join them back on.
+            location = ""
+            path, sep, qs = uri.partition("?")
+        else:
+            # uri may be an absoluteURI (including "http://host.domain.tld");
+            scheme, location, path, params, qs, frag = urlparse(uri)
+            
+            if frag:
+                self.simple_response("400 Bad Request",
+                                     "Illegal #fragment in Request-URI.")
+                return
+            
+            if scheme:
+                environ["wsgi.url_scheme"] = scheme
+            if params:
+                path = path + ";" + params
         
         # Unquote the path+params (e.g. "/this%20path" -> "this path").
         # http://www.w3.org/Protocols/rfc2616/rfc2616-sec5.html#sec5.1.2
@@ -168,26 +399,28 @@ class HTTPRequest(object):
         # But note that "...a URI must be separated into its components
         # before the escaped characters within those components can be
         # safely decoded." http://www.ietf.org/rfc/rfc2396.txt, sec 2.4.2
-        atoms = [unquote(x) for x in quoted_slash.split(path)]
-        path = "%2F".join(atoms)
+        if "%" in path:
+            atoms = [unquote(x) for x in quoted_slash.split(path)]
+            path = "%2F".join(atoms)
         
         if path == "*":
             # This means, of course, that the last wsgi_app (shortest path)
             # will always handle a URI of "*".
+            mount = server.mounts.shortest()
+            if mount is None:
+                self.simple_response("404 Not Found")
+                return
+            self.mount_point, self.wsgi_app = mount
             environ["SCRIPT_NAME"] = ""
             environ["PATH_INFO"] = "*"
-            self.wsgi_app = server.mount_points[-1][1]
         else:
-            for mount_point, wsgi_app in server.mount_points:
-                # The mount_points list should be sorted by length, descending.
-                if path.startswith(mount_point + "/") or path == mount_point:
-                    environ["SCRIPT_NAME"] = mount_point
-                    environ["PATH_INFO"] = path[len(mount_point):]
-                    self.wsgi_app = wsgi_app
-                    break
-            else:
+            mount = server.mounts.match(path)
+            if mount is None:
                 self.simple_response("404 Not Found")
                 return
+            self.mount_point, self.wsgi_app = mount
+            environ["SCRIPT_NAME"] = self.mount_point
+            environ["PATH_INFO"] = path[len(self.mount_point):]
         
         # Note that, like wsgiref and most other WSGI servers,
         # we unquote the path but not the query string.
@@ -224,7 +457,10 @@ class HTTPRequest(object):
         
         # then all the http headers
         try:
-            self.read_headers()
+            if header_lines is None:
+                self.read_headers()
+            else:
+                self.parse_headers(header_lines)
         except ValueError, ex:
             self.simple_response("400 Bad Request", repr(ex.args))
             return
@@ -264,10 +500,6 @@ class HTTPRequest(object):
                     self.close_connection = True
                     return
         
-        if read_chunked:
-            if not self.decode_chunked():
-                return
-        
         # From PEP 333:
         # "Servers and gateways that implement HTTP 1.1 must provide
         # transparent support for HTTP 1.1's "expect/continue" mechanism.
@@ -283,10 +515,35 @@ class HTTPRequest(object):
         #      expect/continue, and sends the request body on its own.
         #      (This is suboptimal, and is not recommended.)
         #
-        # We used to do 3, but are now doing 1. Maybe we'll do 2 someday,
-        # but it seems like it would be a big slowdown for such a rare case.
-        if environ.get("HTTP_EXPECT", "") == "100-continue":
-            self.simple_response(100)
+        # We do 2: the wsgi.input stream sends it on first read, so an app
+        # can refuse an upload without the client ever sending it.
+        send_continue = None
+        if (environ.get("HTTP_EXPECT", "") == "100-continue"
+                and self.response_protocol == "HTTP/1.1"):
+            send_continue = self.send_continue
+        
+        maxlen = server.max_request_body_size
+        if read_chunked:
+            # The decoded length isn't known until the body has been read
+            # (it is no longer read in full up front), so there is no
+            # CONTENT_LENGTH: per PEP 333, wsgi.input is read to its end.
+            environ.pop("CONTENT_LENGTH", None)
+            self.body = ChunkedRFile(self.rfile, maxlen, send_continue)
+        else:
+            try:
+                cl = int(environ.get("CONTENT_LENGTH") or 0)
+                if cl < 0:
+                    raise ValueError(cl)
+            except ValueError:
+                self.simple_response("400 Bad Request",
+                                     "Malformed Content-Length header.")
+                self.close_connection = True
+                return
+            if maxlen and cl > maxlen:
+                self.simple_response("413 Request Entity Too Large")
+                return
+            self.body = KnownLengthRFile(self.rfile, cl, send_continue)
+        environ["wsgi.input"] = self.body
         
         self.ready = True
     
@@ -325,46 +582,77 @@ class HTTPRequest(object):
         if cl:
             environ["CONTENT_LENGTH"] = cl
     
-    def decode_chunked(self):
-        """Decode the 'chunked' transfer coding."""
-        cl = 0
-        data = StringIO.StringIO()
-        while True:
-            line = self.rfile.readline().strip().split(";", 1)
-            chunk_size = int(line.pop(0), 16)
-            if chunk_size <= 0:
-                break
-##            if line: chunk_extension = line[0]
-            cl += chunk_size
-            data.write(self.rfile.read(chunk_size))
-            crlf = self.rfile.read(2)
-            if crlf != "\r\n":
-                self.simple_response("400 Bad Request",
-                                     "Bad chunked transfer coding "
-                                     "(expected '\\r\\n', got %r)" % crlf)
-                return
-        
-        # Grab any trailer headers
-        self.read_headers()
+    def parse_headers(self, lines):
+        """Set environ entries from the given header lines (sans CRLF)."""
+        environ = self.environ
+        keys = _header_keys
+        envname = None
+        for line in lines:
+            if line[:1] in (" ", "\t"):
+                # It's a continuation line.
+                if envname is None:
+                    raise ValueError("Illegal continuation line.")
+                environ[envname] = environ[envname] + " " + line.strip()
+                continue
+            
+            k, sep, v = line.partition(":")
+            if not sep:
+                raise ValueError("Illegal header line.")
+            try:
+                envname, comma_separated = keys[k]
+            except KeyError:
+                envname, comma_separated = _header_key(k)
+            v = v.strip()
+            if comma_separated:
+                existing = environ.get(envname)
+                if existing:
+                    v = ", ".join((existing, v))
+            environ[envname] = v
         
-        data.seek(0)
-        self.environ["wsgi.input"] = data
-        self.environ["CONTENT_LENGTH"] = str(cl) or ""
-        return True
+        ct = environ.pop("HTTP_CONTENT_TYPE", None)
+        if ct:
+            environ["CONTENT_TYPE"] = ct
+        cl = environ.pop("HTTP_CONTENT_LENGTH", None)
+        if cl:
+            environ["CONTENT_LENGTH"] = cl
     
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
-        response = self.wsgi_app(self.environ, self.start_response)
-        try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
+        memory = self.connection.server.memory_collector
+        if memory is None:
+            self.send_response(self.wsgi_app(self.environ,
+                                              self.start_response))
+            return
+        token = memory.begin()
+        try:
+            self.send_response(self.wsgi_app(self.environ,
+                                              self.start_response))
+        finally:
+            memory.end(self.mount_point, token)
+    
+    def send_response(self, response):
+        """Write the given app iterable (and close it), finishing the response."""
+        try:
+            if isinstance(response, FileWrapper) and self.write_file(response):
+                pass
+            elif (isinstance(response, (list, tuple)) and len(response) == 1
+                    and self.started_response and not self.sent_headers):
+                # The whole body is already known, so send it with a
+                # Content-Length instead of chunking it.
+                body = self.encode_body(response[0])
+                self.set_content_length(len(body))
+                if body:
+                    self.write(body)
+            else:
+                for chunk in response:
+                    # "The start_response callable must not actually transmit
+                    # the response headers. Instead, it must store them for the
+                    # server or gateway to transmit only after the first
+                    # iteration of the application return value that yields
+                    # a NON-EMPTY string, or upon the application's first
+                    # invocation of the write() callable." (PEP 333)
+                    if chunk:
+                        self.write(chunk)
         finally:
             if hasattr(response, "close"):
                 response.close()
@@ -372,13 +660,250 @@ class HTTPRequest(object):
                 and not self.connection.server.interrupt):
             self.sent_headers = True
             self.send_headers()
+        if self.encoder is not None:
+            tail = self.encoder.flush()
+            self.encoder = None
+            if tail:
+                self._write_chunk(tail)
         if self.chunked_write:
-            self.sendall("0\r\n\r\n")
+            self._send(["0\r\n\r\n"])
+        elif self._header_buf is not None:
+            self._send([])
+        self.finish_body()
+    
+    def send_continue(self):
+        """Send "100 Continue", unless the final response has started."""
+        if not self.sent_headers:
+            self.sendall("%s 100 Continue\r\n\r\n"
+                         % self.connection.server.protocol)
+    
+    def finish_body(self):
+        """Skip whatever request body the app didn't read.
+        
+        The next request on the connection starts after this one's body,
+        so unread bodies are read and discarded if they are no longer than
+        the server's drain_request_body_size; otherwise (or if the client
+        was never sent "100 Continue") the connection is closed instead.
+        """
+        body = self.body
+        if body is None or body.done or self.close_connection:
+            return
+        if body.awaiting_continue:
+            # The client may well be waiting before it sends the body.
+            self.close_connection = True
+            return
+        limit = self.connection.server.drain_request_body_size
+        try:
+            while not body.done and body.bytes_read <= limit:
+                body.read(8192)
+        except (MaxSizeExceeded, ValueError):
+            pass
+        if not body.done:
+            self.close_connection = True
+    
+    def negotiate_encoding(self, length=None):
+        """Return the content-coding to compress the response with.
+        
+        length: the body's length, if it is known before headers are sent.
+        
+        Returns None if the response can't be compressed at all (the server
+        doesn't compress, the content type isn't one of compress_types, it
+        is already encoded, too short, and so on), or "" if it could be,
+        but the client doesn't accept gzip or deflate.
+        """
+        server = self.connection.server
+        if not server.compress or self.environ["REQUEST_METHOD"] == "HEAD":
+            return None
+        status = self.status[:3]
+        if status[:1] == "1" or status in ("204", "206", "304"):
+            return None
+        content_type = ""
+        for key, value in self.outheaders:
+            key = key.lower()
+            if key == "content-type":
+                content_type = value.lower()
+            elif key == "content-encoding":
+                return None
+            elif key == "content-length" and length is None:
+                try:
+                    length = int(value)
+                except ValueError:
+                    return None
+            elif key == "cache-control" and "no-transform" in value.lower():
+                return None
+        if not content_type.startswith(server.compress_types):
+            return None
+        if length is not None and length < server.compress_min_size:
+            return None
+        return accept_encoding(self.environ.get("HTTP_ACCEPT_ENCODING"))
+    
+    def set_encoding(self, encoding):
+        """Record the response's content-coding and fix up its headers.
+        
+        encoding: "gzip" or "deflate", or "" if the response could have
+            been compressed but wasn't (it still gets Vary: Accept-Encoding).
+        
+        The Content-Length (of the uncompressed body) is dropped and a
+        strong ETag is made weak, since the bytes sent are no longer the
+        entity the app described.
+        """
+        self.encoding = encoding
+        headers = []
+        vary = False
+        for key, value in self.outheaders:
+            lkey = key.lower()
+            if encoding:
+                if lkey == "content-length":
+                    continue
+                if lkey == "etag" and not value.startswith("W/"):
+                    value = "W/" + value
+            if lkey == "vary":
+                vary = True
+                if (value.strip() != "*" and
+                        "accept-encoding" not in value.lower()):
+                    value += ", Accept-Encoding"
+            headers.append((key, value))
+        if not vary:
+            headers.append(("Vary", "Accept-Encoding"))
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        self.outheaders = headers
+    
+    def start_encoding(self):
+        """Choose the encoding of a streamed response, as it starts."""
+        encoding = self.negotiate_encoding()
+        if encoding is None:
+            self.encoding = ""
+            return
+        self.set_encoding(encoding)
+        if encoding:
+            self.encoder = _compressobj(encoding,
+                                        self.connection.server.compress_level)
+    
+    def encode_body(self, body):
+        """Return the whole response body, compressed if it should be.
+        
+        With the server's compress_cache, bodies of responses with a strong
+        ETag are only compressed the first time they are sent (see
+        compress_cache_key).
+        """
+        encoding = self.negotiate_encoding(len(body))
+        if encoding is None:
+            self.encoding = ""
+            return body
+        if encoding:
+            cache = self.connection.server.compress_cache
+            key = None
+            if cache is not None:
+                key = self.compress_cache_key(encoding)
+            compressed = None
+            if key is not None:
+                compressed = cache.get(key)
+            if compressed is None:
+                encoder = _compressobj(encoding,
+                                       self.connection.server.compress_level)
+                compressed = encoder.compress(body) + encoder.flush()
+                if key is not None:
+                    cache.put(key, compressed)
+            if len(compressed) < len(body):
+                self.set_encoding(encoding)
+                return compressed
+        self.set_encoding("")
+        return body
+    
+    def compress_cache_key(self, encoding):
+        """Return the compress_cache key for this response, or None.
+        
+        Only a strong ETag identifies the body's bytes, so responses
+        without one (or with Vary: *) aren't cached. Besides the ETag, the
+        key holds the host and URI, and the values of the request headers
+        named in the response's Vary, so a response is never answered with
+        the compressed bytes of another host's or another variant's.
+        """
+        etag = None
+        vary = []
+        for key, value in self.outheaders:
+            key = key.lower()
+            if key == "etag":
+                etag = value
+            elif key == "vary":
+                vary.extend(value.split(","))
+        if etag is None or etag.startswith("W/"):
+            return None
+        environ = self.environ
+        varying = []
+        for name in vary:
+            name = name.strip()
+            if name == "*":
+                return None
+            if not name or name.lower() == "accept-encoding":
+                # (the encoding is in the key already)
+                continue
+            envname = _header_key(name)[0]
+            if envname in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                envname = envname[5:]
+            varying.append((envname, environ.get(envname)))
+        varying.sort()
+        return (encoding, etag, environ.get("wsgi.url_scheme"),
+                environ.get("HTTP_HOST") or environ.get("SERVER_NAME"),
+                environ.get("SCRIPT_NAME"), environ.get("PATH_INFO"),
+                environ.get("QUERY_STRING"), tuple(varying))
+    
+    def set_content_length(self, length):
+        """Add a Content-Length header unless the response forbids one."""
+        for key, value in self.outheaders:
+            if key.lower() == "content-length":
+                return
+        status = self.status[:3]
+        if status[0] != "1" and status not in ("204", "304"):
+            self.outheaders.append(("Content-Length", str(length)))
+    
+    def write_file(self, wrapper):
+        """Send a wsgi.file_wrapper response with sendfile(), if possible.
+        
+        Returns False, having sent nothing, if the response cannot be sent
+        that way (no sendfile, SSL, not a regular file, and so on); the
+        caller should then iterate over it as usual.
+        """
+        if (_sendfile is None or not self.connection.can_sendfile
+                or not self.started_response or self.sent_headers):
+            return False
+        try:
+            fd = wrapper.filelike.fileno()
+            offset = wrapper.filelike.tell()
+            st = os.fstat(fd)
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        
+        count = max(st.st_size - offset, 0)
+        for key, value in self.outheaders:
+            if key.lower() == "content-length":
+                try:
+                    length = int(value)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # Leave a bad header to the usual path.
+                    return False
+                count = min(count, length)
+                break
+        else:
+            self.set_content_length(count)
+        
+        self.sent_headers = True
+        self.send_headers()
+        self._send([])
+        _sendfile_all(self.connection.socket, fd, offset, count,
+                      self.connection.server.timeout)
+        self.bytes_written += count
+        return True
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
         status = str(status)
-        buf = ["%s %s\r\n" % (self.connection.server.protocol, status),
+        buf = [status_line(self.connection.server.protocol, status),
                "Content-Length: %s\r\n" % len(msg)]
         
         if status[:3] == "413" and self.response_protocol == 'HTTP/1.1':
@@ -389,7 +914,11 @@ class HTTPRequest(object):
         buf.append("\r\n")
         if msg:
             buf.append(msg)
-        self.sendall("".join(buf))
+        if not self.started_response:
+            self.status = status
+        buf = "".join(buf)
+        self.bytes_written += len(buf)
+        self.sendall(buf)
     
     def start_response(self, status, headers, exc_info = None):
         """WSGI callable to begin the HTTP response."""
@@ -418,23 +947,65 @@ class HTTPRequest(object):
         
         if not self.sent_headers:
             self.sent_headers = True
+            if self.encoding is None:
+                self.start_encoding()
             self.send_headers()
         
+        if self.encoder is not None:
+            chunk = self.encoder.compress(chunk)
+            if not chunk:
+                # zlib is holding on to it for now.
+                return
+        self._write_chunk(chunk)
+    
+    def _write_chunk(self, chunk):
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.sendall("".join(buf))
+            self._send(["%x\r\n" % len(chunk), chunk, "\r\n"])
         else:
-            self.sendall(chunk)
+            self._send([chunk])
+    
+    def _send(self, pieces):
+        """Send the given strings, preceded by the pending response head."""
+        if self._header_buf is not None:
+            pieces.insert(0, self._header_buf)
+            self._header_buf = None
+        if pieces:
+            for piece in pieces:
+                self.bytes_written += len(piece)
+            self.connection.sendv(pieces)
     
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers."""
-        hkeys = [key.lower() for key, value in self.outheaders]
-        status = int(self.status[:3])
+        server = self.connection.server
+        if not server.ready:
+            # The server is stopping; don't hold the connection open.
+            self.close_connection = True
+        buf = [status_line(server.protocol, self.status)]
+        flags = _response_header_flags
+        found = 0
+        try:
+            for k, v in self.outheaders:
+                buf.append(k + ": " + v + "\r\n")
+                flag = flags.get(k)
+                if flag is None:
+                    # An unusual spelling, or just a header we don't
+                    # care about; the lower() is the slow path.
+                    flag = flags.get(k.lower(), 0)
+                found |= flag
+        except TypeError:
+            if not isinstance(k, str):
+                raise TypeError("WSGI response header key %r is not a string.")
+            if not isinstance(v, str):
+                raise TypeError("WSGI response header value %r is not a string.")
+            else:
+                raise
         
+        extra = []
+        status = int(self.status[:3])
         if status == 413:
             # Request Entity Too Large. Close conn to avoid garbage.
             self.close_connection = True
-        elif "content-length" not in hkeys:
+        elif not found & _HAS_CONTENT_LENGTH:
             # "All 1xx (informational), 204 (no content),
             # and 304 (not modified) responses MUST NOT
             # include a message-body." So no point chunking.
@@ -444,39 +1015,206 @@ class HTTPRequest(object):
                 if self.response_protocol == 'HTTP/1.1':
                     # Use the chunked transfer-coding
                     self.chunked_write = True
-                    self.outheaders.append(("Transfer-Encoding", "chunked"))
+                    extra.append(("Transfer-Encoding", "chunked"))
                 else:
                     # Closing the conn is the only way to determine len.
                     self.close_connection = True
         
-        if "connection" not in hkeys:
+        if not found & _HAS_CONNECTION:
             if self.response_protocol == 'HTTP/1.1':
                 if self.close_connection:
-                    self.outheaders.append(("Connection", "close"))
+                    extra.append(("Connection", "close"))
             else:
                 if not self.close_connection:
-                    self.outheaders.append(("Connection", "Keep-Alive"))
-        
-        if "date" not in hkeys:
-            self.outheaders.append(("Date", rfc822.formatdate()))
+                    extra.append(("Connection", "Keep-Alive"))
         
-        server = self.connection.server
+        if not found & _HAS_DATE:
+            extra.append(("Date", http_date()))
         
-        if "server" not in hkeys:
+        if extra:
+            self.outheaders.extend(extra)
+            buf += [k + ": " + v + "\r\n" for k, v in extra]
+        if not found & _HAS_SERVER:
             self.outheaders.append(("Server", server.version))
-        
-        buf = [server.protocol, " ", self.status, "\r\n"]
-        try:
-            buf += [k + ": " + v + "\r\n" for k, v in self.outheaders]
-        except TypeError:
-            if not isinstance(k, str):
-                raise TypeError("WSGI response header key %r is not a string.")
-            if not isinstance(v, str):
-                raise TypeError("WSGI response header value %r is not a string.")
-            else:
-                raise
+            buf.append(server.server_line())
         buf.append("\r\n")
-        self.sendall("".join(buf))
+        self._header_buf = "".join(buf)
+
+
+class MaxSizeExceeded(Exception):
+    """Raised when a request body is longer than max_request_body_size."""
+    pass
+
+
+class RequestBody(object):
+    """Base class for the wsgi.input streams HTTPRequest gives apps.
+    
+    rfile: the connection's (buffered) read fileobject.
+    send_continue: a callable which sends "100 Continue" to the client,
+        or None. It is called at most once, when the body is first read.
+    
+    done: True once the whole body has been read from rfile.
+    bytes_read: the number of body bytes read so far.
+    """
+    
+    def __init__(self, rfile, send_continue=None):
+        self.rfile = rfile
+        self._send_continue = send_continue
+        self.done = False
+        self.bytes_read = 0
+    
+    def _get_awaiting_continue(self):
+        return self._send_continue is not None
+    awaiting_continue = property(_get_awaiting_continue,
+                                 doc="True if a 100 Continue is still due.")
+    
+    def _begin(self):
+        if self._send_continue is not None:
+            send, self._send_continue = self._send_continue, None
+            send()
+    
+    def readlines(self, sizehint=0):
+        total = 0
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return lines
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+    
+    def close(self):
+        pass
+
+
+class KnownLengthRFile(RequestBody):
+    """wsgi.input for a request body with a Content-Length.
+    
+    Reads never go past the end of the body (into the next request).
+    """
+    
+    def __init__(self, rfile, content_length, send_continue=None):
+        RequestBody.__init__(self, rfile, send_continue)
+        self.remaining = content_length
+        self.done = not content_length
+    
+    def _consumed(self, data):
+        # (only called for reads of at least one byte)
+        if data:
+            self.remaining -= len(data)
+            self.bytes_read += len(data)
+        else:
+            # The client hung up.
+            self.remaining = 0
+        self.done = not self.remaining
+        return data
+    
+    def read(self, size=None):
+        if self.done or size == 0:
+            return ""
+        self._begin()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        return self._consumed(self.rfile.read(size))
+    
+    def readline(self, size=None):
+        if self.done or size == 0:
+            return ""
+        self._begin()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        return self._consumed(self.rfile.readline(size))
+
+
+class ChunkedRFile(RequestBody):
+    """wsgi.input which decodes a "chunked" request body as it is read.
+    
+    maxlen: the most body bytes to accept (0 = no limit). Reading past it
+        raises MaxSizeExceeded.
+    
+    Trailer headers, if any, are read and kept in the trailers list. The
+    body's length is only known once it has all been read: bytes_read.
+    """
+    
+    def __init__(self, rfile, maxlen=0, send_continue=None):
+        RequestBody.__init__(self, rfile, send_continue)
+        self.maxlen = maxlen
+        self.trailers = []
+        self._chunk_left = 0
+    
+    def _next_chunk(self):
+        if self._chunk_left == 0 and self.bytes_read:
+            # Finish off the previous chunk.
+            crlf = self.rfile.read(2)
+            if crlf != "\r\n":
+                raise ValueError("Bad chunked transfer coding "
+                                 "(expected '\\r\\n', got %r)" % crlf)
+        line = self.rfile.readline()
+        if not line:
+            raise ValueError("Request body ended before its last chunk.")
+        try:
+            chunk_size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Bad chunked transfer size: %r" % line)
+        if chunk_size <= 0:
+            # Read (and keep) any trailer headers.
+            while True:
+                line = self.rfile.readline()
+                if line in ("\r\n", "\n", ""):
+                    break
+                self.trailers.append(line.rstrip("\r\n"))
+            self.done = True
+            return
+        if self.maxlen and self.bytes_read + chunk_size > self.maxlen:
+            raise MaxSizeExceeded()
+        self._chunk_left = chunk_size
+    
+    def _read(self, size, lines):
+        if size == 0:
+            # (without sending "100 Continue" for it)
+            return ""
+        if lines:
+            reader = self.rfile.readline
+        else:
+            reader = self.rfile.read
+        self._begin()
+        chunks = []
+        got = 0
+        while not self.done and (size is None or size < 0 or got < size):
+            if not self._chunk_left:
+                self._next_chunk()
+                continue
+            want = self._chunk_left
+            if size is not None and 0 <= size and size - got < want:
+                want = size - got
+            data = reader(want)
+            if not data:
+                raise ValueError("Request body ended inside a chunk.")
+            chunks.append(data)
+            got += len(data)
+            self.bytes_read += len(data)
+            self._chunk_left -= len(data)
+            if lines and data[-1] == "\n":
+                break
+        return "".join(chunks)
+    
+    def read(self, size=None):
+        return self._read(size, False)
+    
+    def readline(self, size=None):
+        return self._read(size, True)
 
 
 class NoSSLError(Exception):
@@ -545,42 +1283,233 @@ class SSL_fileobject(socket._fileobject):
     readlines = _ssl_wrap_method(socket._fileobject.readlines, is_reader=True)
 
 
-class HTTPConnection(object):
-    """An HTTP connection (active socket).
+class SocketReader(object):
+    """Buffered, file-like reader over a plain (non-SSL) socket.
     
-    socket: the raw socket object (usually TCP) for this connection.
-    addr: the "bind address" for the remote end of the socket.
-        For IP sockets, this is a tuple of (REMOTE_ADDR, REMOTE_PORT).
-        For UNIX domain sockets, this will be a string.
-    server: the HTTP Server for this Connection. Usually, the server
-        object possesses a passive (server) socket which spawns multiple,
-        active (client) sockets, one for each connection.
+    Unlike socket._fileobject, the read buffer (a bytearray) is kept where
+    the server can see it: bytes received by the ConnectionSelector while
+    the connection was idle stay in the buffer when the connection is
+    handed to a worker, and read_head() can find the end of a request head
+    with one search of the buffer instead of reading line by line.
     
-    environ: a WSGI environ template. This will be copied for each request.
-    rfile: a fileobject for reading from the socket.
-    sendall: a function for writing (+ flush) to the socket.
+    The buffer lives as long as the connection. Reads advance an offset
+    into it rather than cutting bytes off the front, so several pipelined
+    requests that arrived in one recv() are parsed straight out of it; the
+    consumed bytes are only discarded once compact_size have piled up (or
+    the buffer is empty).
+    
+    sock: the socket to read from.
+    bufsize: the number of bytes to ask for on each recv() call, to start
+        with. It doubles (up to max_bufsize) whenever a recv() fills it, so
+        a client sending a lot at once is read in fewer calls.
     """
     
-    rbufsize = -1
-    RequestHandlerClass = HTTPRequest
-    environ = {"wsgi.version": (1, 0),
-               "wsgi.url_scheme": "http",
-               "wsgi.multithread": True,
-               "wsgi.multiprocess": False,
-               "wsgi.run_once": False,
-               "wsgi.errors": sys.stderr,
-               }
+    max_bufsize = 65536
+    compact_size = 16384
     
-    def __init__(self, sock, addr, server):
-        self.socket = sock
-        self.addr = addr
-        self.server = server
-        
-        # Copy the class environ into self.
-        self.environ = self.environ.copy()
-        
-        if SSL and isinstance(sock, SSL.ConnectionType):
-            timeout = sock.gettimeout()
+    def __init__(self, sock, bufsize=8192):
+        self._sock = sock
+        self.bufsize = bufsize
+        self._buf = bytearray()
+        self._pos = 0
+        self.closed = False
+    
+    def _recv(self, size):
+        while True:
+            try:
+                data = self._sock.recv(size)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if len(data) >= self.bufsize and self.bufsize < self.max_bufsize:
+                self.bufsize *= 2
+            return data
+    
+    def _take(self, size):
+        buf = self._buf
+        start = self._pos
+        end = start + size
+        data = str(buf[start:end])
+        if end >= len(buf):
+            del buf[:]
+            self._pos = 0
+        elif end >= self.compact_size:
+            del buf[:end]
+            self._pos = 0
+        else:
+            self._pos = end
+        return data
+    
+    def fill(self):
+        """Receive once into the buffer and return the number of new bytes.
+        
+        Zero means the peer closed the connection. On a non-blocking socket
+        this raises socket.error(EAGAIN) if nothing was ready.
+        """
+        data = self._recv(self.bufsize)
+        self._buf += data
+        return len(data)
+    
+    def buffered(self):
+        """Return the number of bytes received but not yet read."""
+        return len(self._buf) - self._pos
+    
+    def has_head(self):
+        """Return True if a complete request head is buffered."""
+        return self._buf.find("\r\n\r\n", self._pos) >= 0
+    
+    def read_head(self, limit):
+        """Read and return the next request head, up to its blank line.
+        
+        Returns "" if the connection closed before any bytes arrived.
+        Raises ValueError if the head is truncated or longer than limit.
+        """
+        buf = self._buf
+        pos = self._pos
+        start = pos
+        while True:
+            end = buf.find("\r\n\r\n", start)
+            if end >= 0:
+                return self._take(end + 4 - pos)
+            if len(buf) - pos > limit:
+                raise ValueError("Request header is too large.")
+            # The terminator may straddle the old and new data.
+            start = max(len(buf) - 3, pos)
+            data = self._recv(self.bufsize)
+            if not data:
+                if len(buf) > pos:
+                    raise ValueError("Illegal end of headers.")
+                return ""
+            buf += data
+    
+    def read(self, size=-1):
+        buf = self._buf
+        pos = self._pos
+        if 0 <= size <= len(buf) - pos:
+            return self._take(size)
+        
+        chunks = [str(buf[pos:])]
+        got = len(buf) - pos
+        del buf[:]
+        self._pos = 0
+        while size < 0 or got < size:
+            if size < 0:
+                data = self._recv(self.bufsize)
+            else:
+                # Don't ask recv() for (and so allocate) a huge buffer.
+                data = self._recv(max(self.bufsize,
+                                      min(size - got, 65536)))
+            if not data:
+                break
+            chunks.append(data)
+            got += len(data)
+        data = "".join(chunks)
+        if 0 <= size < got:
+            buf += data[size:]
+            data = data[:size]
+        return data
+    
+    def readline(self, size=-1):
+        buf = self._buf
+        pos = self._pos
+        start = pos
+        while True:
+            end = buf.find("\n", start)
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= size <= len(buf) - pos:
+                end = pos + size
+                break
+            start = len(buf)
+            data = self._recv(self.bufsize)
+            if not data:
+                end = len(buf)
+                break
+            buf += data
+        if 0 <= size < end - pos:
+            end = pos + size
+        return self._take(end - pos)
+    
+    def readlines(self, sizehint=0):
+        total = 0
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return lines
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+    
+    def close(self):
+        self.closed = True
+        del self._buf[:]
+        self._pos = 0
+
+
+class HTTPConnection(object):
+    """An HTTP connection (active socket).
+    
+    socket: the raw socket object (usually TCP) for this connection.
+    addr: the "bind address" for the remote end of the socket.
+        For IP sockets, this is a tuple of (REMOTE_ADDR, REMOTE_PORT).
+        For UNIX domain sockets, this will be a string.
+    server: the HTTP Server for this Connection. Usually, the server
+        object possesses a passive (server) socket which spawns multiple,
+        active (client) sockets, one for each connection.
+    
+    environ: a WSGI environ template. This will be copied for each request.
+    rfile: a fileobject for reading from the socket.
+    sendall: a function for writing (+ flush) to the socket.
+    sendv: a function for writing a list of strings to the socket; see
+        gather_limit.
+    can_sendfile: True if file bodies may be written to the socket with
+        sendfile() (i.e. the socket is not SSL).
+    
+    gather_limit: when the socket has no sendmsg() (Python 2), sendv joins
+        pieces shorter than this many bytes into a single send; longer
+        pieces are sent as they are rather than copied.
+    """
+    
+    rbufsize = -1
+    gather_limit = 16384
+    closed = False
+    RequestHandlerClass = HTTPRequest
+    environ = {"wsgi.version": (1, 0),
+               "wsgi.url_scheme": "http",
+               "wsgi.multithread": True,
+               "wsgi.multiprocess": False,
+               "wsgi.run_once": False,
+               "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
+               }
+    
+    def __init__(self, sock, addr, server):
+        self.socket = sock
+        self.addr = addr
+        self.server = server
+        server._count_connection(1)
+        if server.memory_collector is not None:
+            server.memory_collector.track(self)
+        
+        # Copy the class environ into self.
+        self.environ = self.environ.copy()
+        
+        if SSL and isinstance(sock, SSL.ConnectionType):
+            timeout = sock.gettimeout()
             self.rfile = SSL_fileobject(sock, "r", self.rbufsize)
             self.rfile.ssl_timeout = timeout
             self.sendall = _ssl_wrap_method(sock.sendall)
@@ -589,12 +1518,24 @@ class HTTPConnection(object):
             sslenv = getattr(server, "ssl_environ", None)
             if sslenv:
                 self.environ.update(sslenv)
+            self.sendv = self._sendv_joined
+            self.can_sendfile = False
         else:
-            self.rfile = sock.makefile("rb", self.rbufsize)
+            # The selector (if any) reads request heads itself, so the
+            # buffer it fills must be the same one requests are parsed from.
+            self.rfile = SocketReader(sock)
             self.sendall = sock.sendall
+            if hasattr(sock, "sendmsg"):
+                self.sendv = self._sendv_gathered
+            else:
+                self.sendv = self._sendv_joined
+            self.can_sendfile = True
         
         self.environ.update({"wsgi.input": self.rfile,
+                             "wsgi.multiprocess": self.server.multiprocess,
                              "SERVER_NAME": self.server.server_name,
+                             "SERVER_SOFTWARE": "%s WSGI Server"
+                                                % self.server.version,
                              })
         
         if isinstance(self.server.bind_addr, basestring):
@@ -609,7 +1550,17 @@ class HTTPConnection(object):
             self.environ["REMOTE_PORT"] = str(self.addr[1])
     
     def communicate(self):
-        """Read each request and respond appropriately."""
+        """Read each request and respond appropriately.
+        
+        Returns True if the connection is still open and idle and should
+        be handed back to the server's ConnectionSelector to wait for its
+        next request; any false value means the connection should close.
+        """
+        selector = self.server.selector
+        stats = self.server.stats_collector
+        if stats is not None:
+            now = time.time()
+            waited = now - getattr(self, "queued_at", now)
         try:
             while True:
                 # (re)set req to None so that if something goes wrong in
@@ -618,12 +1569,33 @@ class HTTPConnection(object):
                 req = None
                 req = self.RequestHandlerClass(self)
                 # This order of operations should guarantee correct pipelining.
-                req.parse_request()
-                if not req.ready:
-                    return
-                req.respond()
+                if stats is None:
+                    req.parse_request()
+                    if not req.ready:
+                        return False
+                    req.respond()
+                else:
+                    start = time.time()
+                    req.parse_request()
+                    parsed = time.time()
+                    if not req.ready:
+                        if req.status:
+                            stats.record(req.mount_point, req.status, waited,
+                                         parsed - start, None,
+                                         req.bytes_written)
+                        return False
+                    req.respond()
+                    stats.record(req.mount_point, req.status, waited,
+                                 parsed - start, time.time() - parsed,
+                                 req.bytes_written)
+                    # Pipelined requests didn't wait in the Queue.
+                    waited = 0.0
                 if req.close_connection:
-                    return
+                    return False
+                if selector is not None and not self.rfile.has_head():
+                    # Don't block this worker waiting on a keep-alive
+                    # client; pipelined requests are answered right away.
+                    return True
         except socket.error, e:
             errno = e.args[0]
             if errno not in socket_errors_to_ignore:
@@ -633,6 +1605,10 @@ class HTTPConnection(object):
             return
         except (KeyboardInterrupt, SystemExit):
             raise
+        except MaxSizeExceeded:
+            if req and not req.sent_headers:
+                req.simple_response("413 Request Entity Too Large")
+            return False
         except NoSSLError:
             # Unwrap our sendall
             req.sendall = self.socket._sock.sendall
@@ -640,13 +1616,47 @@ class HTTPConnection(object):
                                 "The client sent a plain HTTP request, but "
                                 "this server only speaks HTTPS on this port.")
         except:
+            if stats is not None:
+                stats.error()
             if req:
                 req.simple_response("500 Internal Server Error", format_exc())
     
+    def _sendv_gathered(self, pieces):
+        sendmsg = self.socket.sendmsg
+        while pieces:
+            sent = sendmsg(pieces)
+            while pieces and sent >= len(pieces[0]):
+                sent -= len(pieces.pop(0))
+            if sent:
+                pieces[0] = memoryview(pieces[0])[sent:]
+    
+    def _sendv_joined(self, pieces):
+        if len(pieces) == 1:
+            self.sendall(pieces[0])
+            return
+        limit = self.gather_limit
+        buf = []
+        for piece in pieces:
+            if len(piece) < limit:
+                buf.append(piece)
+                continue
+            # Send big pieces (i.e. body chunks) as they are, after
+            # whatever framing came before them.
+            if buf:
+                self.sendall("".join(buf))
+                buf = []
+            self.sendall(piece)
+        if buf:
+            self.sendall("".join(buf))
+    
     def close(self):
         """Close the socket underlying this connection."""
+        if self.closed:
+            return
+        self.closed = True
         self.rfile.close()
         self.socket.close()
+        self.server._count_connection(-1)
 
 
 def format_exc(limit=None):
@@ -677,24 +1687,474 @@ class WorkerThread(threading.Thread):
     def __init__(self, server):
         self.ready = False
         self.server = server
+        self.idle_since = None
         threading.Thread.__init__(self)
     
     def run(self):
         try:
             self.ready = True
             while True:
-                conn = self.server.requests.get()
+                conn = self.server.requests.get(self)
                 if conn is _SHUTDOWNREQUEST:
                     return
                 
+                max_wait = self.server.max_queue_wait
+                if max_wait and time.time() - conn.queued_at > max_wait:
+                    # The client has probably given up already; answering
+                    # it now would only make the next one wait longer.
+                    self.server.reject(conn)
+                    continue
+                
+                keepalive = False
                 try:
-                    conn.communicate()
+                    keepalive = conn.communicate()
                 finally:
-                    conn.close()
+                    selector = self.server.selector
+                    if keepalive and selector is not None:
+                        selector.park(conn)
+                    else:
+                        conn.close()
         except (KeyboardInterrupt, SystemExit), exc:
             self.server.interrupt = exc
 
 
+class ThreadPool(object):
+    """A Queue of connections and the elastic set of WorkerThreads serving it.
+    
+    server: the HTTP Server which owns this pool.
+    min: the number of worker threads to keep running, even when idle.
+    max: the largest number of worker threads to run at once.
+    maxsize: the maximum number of queued connections (-1 = no limit).
+        put() never blocks: connections which don't fit are handed to
+        server.reject().
+    
+    The pool grows (one thread at a time, up to max) when a connection is
+    queued and there are fewer idle workers than queued connections, and
+    from maintain() when the oldest queued connection has waited longer
+    than grow_wait seconds. Workers beyond min which have been idle for
+    idle_timeout seconds are retired by maintain(), which the server
+    calls on each tick().
+    """
+    
+    grow_wait = 0.1
+    idle_timeout = 60
+    
+    def __init__(self, server, min=10, max=10, maxsize=-1):
+        self.server = server
+        self.min = min
+        self.max = max
+        self.maxsize = maxsize
+        self._queue = Queue.Queue(maxsize)
+        self._threads = []
+        self._idle = 0
+        self._retiring = 0
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Start min workers and wait until they are all polling the Queue."""
+        self.grow(self.min)
+        for worker in self._threads[:]:
+            while not worker.ready:
+                time.sleep(.1)
+    
+    def _get_size(self):
+        return len(self._threads)
+    size = property(_get_size, doc="The number of running worker threads.")
+    
+    def _get_idle(self):
+        return self._idle
+    idle = property(_get_idle, doc="The number of workers waiting for work.")
+    
+    def qsize(self):
+        """Return the number of connections waiting for a worker."""
+        return self._queue.qsize()
+    
+    def grow(self, amount):
+        """Spawn up to amount new worker threads (never more than max)."""
+        self._lock.acquire()
+        try:
+            amount = min(amount, self.max - len(self._threads))
+            for i in xrange(amount):
+                worker = WorkerThread(self.server)
+                worker.setName("CP WSGIServer " + worker.getName())
+                self._threads.append(worker)
+                worker.start()
+        finally:
+            self._lock.release()
+    
+    def put(self, conn):
+        """Queue the given connection for the next available worker.
+        
+        Returns False (having rejected the connection) if the Queue is full.
+        """
+        conn.queued_at = time.time()
+        try:
+            self._queue.put_nowait(conn)
+        except Queue.Full:
+            self.server.reject(conn)
+            return False
+        if (self._idle - self._retiring < self._queue.qsize()
+                and len(self._threads) < self.max):
+            self.grow(1)
+        return True
+    
+    def put_many(self, conns):
+        """Queue several connections, growing the pool once for them all.
+        
+        Connections which don't fit in the Queue are rejected, as by put().
+        """
+        now = time.time()
+        queue = self._queue
+        for conn in conns:
+            conn.queued_at = now
+            try:
+                queue.put_nowait(conn)
+            except Queue.Full:
+                self.server.reject(conn)
+        waiting = queue.qsize()
+        if self._idle - self._retiring < waiting:
+            self.grow(waiting - self._idle + self._retiring)
+    
+    def get(self, worker):
+        """Block until a connection (or _SHUTDOWNREQUEST) is available."""
+        self._lock.acquire()
+        try:
+            self._idle += 1
+            worker.idle_since = time.time()
+        finally:
+            self._lock.release()
+        
+        conn = self._queue.get()
+        
+        self._lock.acquire()
+        try:
+            self._idle -= 1
+            worker.idle_since = None
+            if conn is _SHUTDOWNREQUEST:
+                if worker in self._threads:
+                    self._threads.remove(worker)
+                if self._retiring:
+                    self._retiring -= 1
+        finally:
+            self._lock.release()
+        return conn
+    
+    def _oldest_wait(self, now):
+        queue = self._queue
+        queue.mutex.acquire()
+        try:
+            for conn in queue.queue:
+                if conn is not _SHUTDOWNREQUEST:
+                    return now - conn.queued_at
+            return 0
+        finally:
+            queue.mutex.release()
+    
+    def maintain_timeout(self):
+        """Return the seconds until maintain() could next have work to do.
+        
+        None means not until something is queued (or the pool is fixed).
+        """
+        size = len(self._threads)
+        if size < self.max and self._queue.qsize():
+            return self.grow_wait
+        if size > self.min:
+            return self.idle_timeout
+        return None
+    
+    def maintain(self):
+        """Grow if connections are waiting too long; retire idle workers."""
+        now = time.time()
+        if (len(self._threads) < self.max and
+                self._oldest_wait(now) > self.grow_wait):
+            self.grow(max(1, self._queue.qsize() - self._idle))
+            return
+        
+        self._lock.acquire()
+        try:
+            deadline = now - self.idle_timeout
+            stale = 0
+            for worker in self._threads:
+                if worker.idle_since is not None and worker.idle_since < deadline:
+                    stale += 1
+            surplus = len(self._threads) - self._retiring - self.min
+            retire = min(stale - self._retiring, surplus)
+            if retire > 0:
+                self._retiring += retire
+        finally:
+            self._lock.release()
+        
+        for i in xrange(retire):
+            # Whichever idle workers take these will exit.
+            self._queue.put(_SHUTDOWNREQUEST)
+    
+    def stop(self):
+        """Stop every worker thread and wait for them to exit."""
+        self._lock.acquire()
+        try:
+            workers, self._threads = self._threads, []
+        finally:
+            self._lock.release()
+        
+        # Must shut down threads here so the code that calls
+        # this method can know when all threads are stopped.
+        for worker in workers:
+            self._queue.put(_SHUTDOWNREQUEST)
+        
+        # Don't join currentThread (when stop is called inside a request).
+        current = threading.currentThread()
+        for worker in workers:
+            if worker is not current and worker.isAlive():
+                try:
+                    worker.join()
+                except AssertionError:
+                    pass
+        
+        self._queue = Queue.Queue(self.maxsize)
+        self._idle = 0
+        self._retiring = 0
+
+
+class WakeupPipe(object):
+    """A pipe which any thread can write to, to wake a select()/poll() loop.
+    
+    Include fileno() in the set of descriptors being waited on, and call
+    drain() when it is readable.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.closed = False
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    
+    def fileno(self):
+        return self._r
+    
+    def wakeup(self):
+        """Make the read end readable (safe to call from any thread)."""
+        self._lock.acquire()
+        try:
+            if not self.closed:
+                try:
+                    os.write(self._w, "x")
+                except OSError:
+                    # The pipe is full; a wakeup is already pending.
+                    pass
+        finally:
+            self._lock.release()
+    
+    def drain(self):
+        """Consume all pending wakeups."""
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError:
+            pass
+    
+    def close(self):
+        self._lock.acquire()
+        try:
+            if not self.closed:
+                self.closed = True
+                os.close(self._r)
+                os.close(self._w)
+        finally:
+            self._lock.release()
+
+
+class ConnectionSelector(object):
+    """Event loop which owns listening and idle (keep-alive) sockets.
+    
+    server: the HTTP Server which owns this selector. Its tick() method
+        calls poll() in place of a blocking accept(); each time the
+        listening socket is readable, up to server.accept_batch pending
+        connections are accepted.
+    
+    New and idle connections are registered with epoll (or poll, where
+    epoll is not available) instead of occupying a WorkerThread. Whenever
+    one becomes readable, the selector reads into the connection's
+    SocketReader; once a complete request head has arrived, the connection
+    is put on the server's Queue. Workers hand keep-alive connections back
+    via park() when they have finished answering.
+    
+    Connections which stay idle for longer than server.keepalive_timeout
+    are closed.
+    """
+    
+    sweep_interval = 1.0
+    
+    def __init__(self, server):
+        self.server = server
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._poll = self._poller.poll
+        else:
+            self._poller = select.poll()
+            self._mask = select.POLLIN | select.POLLERR | select.POLLHUP
+            # Milliseconds; any negative value blocks indefinitely.
+            self._poll = lambda timeout: self._poller.poll(timeout * 1000)
+        
+        # fd -> connection; only touched by the thread running poll().
+        self._conns = {}
+        self._lock = threading.Lock()
+        self._parked = []
+        self._last_sweep = time.time()
+        self._listener = None
+        self.closed = False
+        
+        self._waker = WakeupPipe()
+        self._poller.register(self._waker.fileno(), self._mask)
+    
+    def __len__(self):
+        """Return the number of idle connections being watched."""
+        return len(self._conns)
+    
+    def add_listener(self, sock):
+        """Watch the given listening socket, accepting when it is readable."""
+        sock.setblocking(0)
+        self._listener = sock.fileno()
+        self._poller.register(self._listener, self._mask)
+    
+    def wakeup(self):
+        """Interrupt a poll() in progress (safe to call from any thread)."""
+        self._waker.wakeup()
+    
+    def park(self, conn):
+        """Hand an idle connection back to the selector (from any thread)."""
+        self._lock.acquire()
+        try:
+            if self.closed:
+                conn.close()
+                return
+            self._parked.append(conn)
+        finally:
+            self._lock.release()
+        self.wakeup()
+    
+    def add(self, conn):
+        """Start watching the given idle connection for its next request."""
+        if conn.rfile.has_head():
+            # A pipelined request was already read along with the last one.
+            self.server.requests.put(conn)
+            return
+        conn.socket.settimeout(0.0)
+        fd = conn.socket.fileno()
+        conn.last_active = time.time()
+        self._conns[fd] = conn
+        self._poller.register(fd, self._mask)
+    
+    def _release(self, fd):
+        conn = self._conns.pop(fd)
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+        return conn
+    
+    def _dispatch(self, fd):
+        conn = self._release(fd)
+        conn.socket.settimeout(self.server.timeout)
+        self.server.requests.put(conn)
+    
+    def _close(self, fd):
+        self._release(fd).close()
+    
+    def evict(self, count):
+        """Close up to count of the longest idle connections.
+        
+        Returns the number closed. Like add(), this must only be called
+        by the thread running poll().
+        """
+        if count <= 0 or not self._conns:
+            return 0
+        oldest = heapq.nsmallest(count, self._conns.iteritems(),
+                                 key=lambda item: item[1].last_active)
+        for fd, conn in oldest:
+            self._close(fd)
+        return len(oldest)
+    
+    def _read(self, fd, now):
+        conn = self._conns.get(fd)
+        if conn is None:
+            return
+        try:
+            received = conn.rfile.fill()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._close(fd)
+            return
+        if not received:
+            # The client closed its (idle) connection.
+            self._close(fd)
+        elif (conn.rfile.has_head() or
+              conn.rfile.buffered() > self.server.max_request_header_size):
+            # An oversized head is passed on too, so that the
+            # worker can answer it with an error.
+            self._dispatch(fd)
+        else:
+            conn.last_active = now
+    
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for socket events and handle them.
+        
+        A timeout of None waits until there is something to do.
+        """
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._poll(timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        
+        now = time.time()
+        for fd, event in events:
+            if fd == self._waker.fileno():
+                self._waker.drain()
+            elif fd == self._listener:
+                for conn in self.server.accept_many():
+                    self.add(conn)
+            else:
+                self._read(fd, now)
+        
+        self._lock.acquire()
+        try:
+            parked, self._parked = self._parked, []
+        finally:
+            self._lock.release()
+        for conn in parked:
+            self.add(conn)
+        
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            deadline = now - self.server.keepalive_timeout
+            for fd, conn in self._conns.items():
+                if conn.last_active < deadline:
+                    self._close(fd)
+    
+    def close(self):
+        """Close every idle connection and stop watching all sockets."""
+        self._lock.acquire()
+        try:
+            self.closed = True
+            parked, self._parked = self._parked, []
+        finally:
+            self._lock.release()
+        for conn in parked:
+            conn.close()
+        for fd in self._conns.keys():
+            self._close(fd)
+        if hasattr(self._poller, "close"):
+            self._poller.close()
+        self._waker.close()
+
+
 class SSLConnection:
     """A thread-safe wrapper for an SSL.Connection.
     
@@ -722,20 +2182,588 @@ class SSLConnection:
 """ % (f, f)
 
 
+class Histogram(object):
+    """Counts of observed values (e.g. latencies in seconds) per bucket.
+    
+    bounds: the (ascending) upper bound of each bucket; values above the
+        last bound are counted in a final overflow bucket.
+    
+    Not thread-safe; ServerStats serializes access.
+    """
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the given fraction."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                if i < len(self.bounds):
+                    return self.bounds[i]
+                break
+        return self.max
+    
+    def snapshot(self):
+        return {"count": self.count,
+                "mean": self.count and self.total / self.count,
+                "max": self.max,
+                "p50": self.percentile(.5),
+                "p90": self.percentile(.9),
+                "p99": self.percentile(.99),
+                "buckets": zip(list(self.bounds) + ["+Inf"], self.counts),
+                }
+
+
+class ServerStats(object):
+    """Request counters and per-phase latency histograms, per mount point.
+    
+    Set an instance as server.stats_collector (or pass stats_collector to
+    CherryPyWSGIServer) to have each HTTPConnection record, for every
+    request:
+    
+    queue: seconds the connection waited in the ThreadPool Queue (0 for
+        the second and later requests handled in one go).
+    parse: seconds spent reading and parsing the request head.
+    respond: seconds spent in respond(), i.e. running the WSGI app and
+        writing its output.
+    
+    plus the response status class and the number of bytes written.
+    Connections turned away with a 503 by the server's admission control
+    are counted as "rejected".
+    Any object with the same record/error/opened/rejected/snapshot methods
+    can be used instead, e.g. to feed an external metrics system.
+    """
+    
+    bounds = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+              1, 2.5, 5, 10)
+    phases = ("queue", "parse", "respond")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+        self.rejections = 0
+        self.errors = 0
+        self._mounts = {}
+    
+    def _new_mount(self):
+        stats = {"requests": 0, "bytes_written": 0, "status": {}}
+        for phase in self.phases:
+            stats[phase] = Histogram(self.bounds)
+        return stats
+    
+    def opened(self):
+        """Count an accepted connection."""
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+    
+    def rejected(self):
+        """Count a connection shed (with a 503) because of overload."""
+        self._lock.acquire()
+        try:
+            self.rejections += 1
+        finally:
+            self._lock.release()
+    
+    def error(self):
+        """Count a request which failed with an unexpected exception."""
+        self._lock.acquire()
+        try:
+            self.errors += 1
+        finally:
+            self._lock.release()
+    
+    def record(self, mount_point, status, queue, parse, respond,
+               bytes_written):
+        """Record one request (respond is None if it was rejected)."""
+        self._lock.acquire()
+        try:
+            stats = self._mounts.get(mount_point)
+            if stats is None:
+                stats = self._mounts[mount_point] = self._new_mount()
+            stats["requests"] += 1
+            stats["bytes_written"] += bytes_written
+            status = (status[:1] or "?") + "xx"
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+            stats["queue"].add(queue)
+            stats["parse"].add(parse)
+            if respond is not None:
+                stats["respond"].add(respond)
+        finally:
+            self._lock.release()
+    
+    def snapshot(self):
+        """Return the statistics so far as a dict of plain values."""
+        self._lock.acquire()
+        try:
+            mounts = {}
+            for mount_point, stats in self._mounts.iteritems():
+                result = {"requests": stats["requests"],
+                          "bytes_written": stats["bytes_written"],
+                          "status": dict(stats["status"])}
+                for phase in self.phases:
+                    result[phase] = stats[phase].snapshot()
+                mounts[mount_point] = result
+        finally:
+            self._lock.release()
+        
+        uptime = time.time() - self.started
+        requests = sum([m["requests"] for m in mounts.itervalues()])
+        return {"uptime": uptime,
+                "connections": self.connections,
+                "rejected": self.rejections,
+                "requests": requests,
+                "requests_per_second": uptime and requests / uptime,
+                "bytes_written": sum([m["bytes_written"]
+                                      for m in mounts.itervalues()]),
+                "errors": self.errors,
+                "mounts": mounts,
+                }
+
+
+try:
+    _page_size = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _page_size = 4096
+
+def memory_usage():
+    """Return the bytes of memory this process is using, as best we can tell.
+    
+    With tracemalloc tracing, that is the size of the traced Python
+    allocations; otherwise the resident set size, from /proc (Linux) or
+    failing that getrusage(), which only knows the peak.
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        f = open("/proc/self/statm")
+        try:
+            return int(f.read().split()[1]) * _page_size
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryStats(object):
+    """Memory accounting for a server, and a watchdog for steady growth.
+    
+    Set an instance as server.memory_collector (or pass memory_collector
+    to CherryPyWSGIServer) to have server.stats() report, under "memory":
+    
+    usage: memory_usage(), in bytes.
+    connections: HTTPConnection objects still alive, whether open or not;
+        closed_connections counts those which were closed but are still
+        referenced from somewhere (if it keeps growing, something leaks
+        them, and with them their buffers and environ).
+    active_requests: requests whose response is being produced.
+    buffered_bytes: bytes received on live connections but not yet read.
+    mounts: for every sample_every'th request, the change in memory
+        usage while it was answered, summed per mount point. Other threads
+        allocate meanwhile, so only a large, persistent difference between
+        mount points means much; with tracemalloc it is far less noisy.
+    
+    trace: if non-zero, start tracemalloc (if it is importable), keeping
+        this many frames per allocation (default 0: don't). dump() then
+        lists the top allocation sites instead of the commonest types.
+    
+    The watchdog (see maintain()) measures usage every check_interval
+    seconds; once it has grown by more than leak_threshold bytes over
+    leak_checks consecutive checks, leak_suspected is set in the snapshot
+    and on_leak (if set) is called with the lines of a dump().
+    """
+    
+    sample_every = 100
+    check_interval = 60.0
+    leak_checks = 10
+    leak_threshold = 16 * 1024 * 1024
+    on_leak = None
+    
+    def __init__(self, trace=0):
+        self._lock = threading.Lock()
+        self._conns = weakref.WeakKeyDictionary()
+        self._requests = 0
+        self.active_requests = 0
+        self._mounts = {}
+        if trace and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(trace)
+        self._next_check = time.time() + self.check_interval
+        self._history = []
+        self.leak_suspected = False
+    
+    def track(self, conn):
+        """Count a new connection for as long as it stays alive."""
+        self._lock.acquire()
+        try:
+            self._conns[conn] = None
+        finally:
+            self._lock.release()
+    
+    def begin(self):
+        """Count a request starting; returns a token to pass to end()."""
+        self._lock.acquire()
+        try:
+            self.active_requests += 1
+            self._requests += 1
+            sample = not self._requests % self.sample_every
+        finally:
+            self._lock.release()
+        if sample:
+            return memory_usage()
+        return None
+    
+    def end(self, mount_point, token):
+        """Count a request finished (token being what begin() returned)."""
+        growth = None
+        if token is not None:
+            growth = memory_usage() - token
+        self._lock.acquire()
+        try:
+            self.active_requests -= 1
+            if growth is not None:
+                stats = self._mounts.get(mount_point)
+                if stats is None:
+                    stats = self._mounts[mount_point] = {"samples": 0,
+                                                         "growth": 0}
+                stats["samples"] += 1
+                stats["growth"] += growth
+        finally:
+            self._lock.release()
+    
+    def maintain(self):
+        """Run the watchdog, if a check is due; the server calls this often."""
+        now = time.time()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        history = self._history
+        history.append(memory_usage())
+        del history[:-(self.leak_checks + 1)]
+        if len(history) <= self.leak_checks:
+            return
+        growing = True
+        for i in xrange(1, len(history)):
+            if history[i] <= history[i - 1]:
+                growing = False
+                break
+        leaking = growing and history[-1] - history[0] > self.leak_threshold
+        reported = self.leak_suspected
+        self.leak_suspected = leaking
+        if leaking and not reported and self.on_leak is not None:
+            self.on_leak(self.dump())
+    
+    def snapshot(self):
+        """Return the current memory figures as a dict of plain values."""
+        self._lock.acquire()
+        try:
+            conns = self._conns.keys()
+            mounts = {}
+            for mount_point, stats in self._mounts.iteritems():
+                mounts[mount_point] = dict(stats)
+            active = self.active_requests
+        finally:
+            self._lock.release()
+        
+        closed = 0
+        buffered = 0
+        for conn in conns:
+            if conn.closed:
+                closed += 1
+            else:
+                rfile_buffered = getattr(conn.rfile, "buffered", None)
+                if rfile_buffered is not None:
+                    buffered += rfile_buffered()
+        return {"usage": memory_usage(),
+                "tracing": bool(tracemalloc and tracemalloc.is_tracing()),
+                "connections": len(conns),
+                "closed_connections": closed,
+                "active_requests": active,
+                "buffered_bytes": buffered,
+                "leak_suspected": self.leak_suspected,
+                "mounts": mounts,
+                }
+    
+    def dump(self, limit=20):
+        """Return a report of where memory is going, as a list of lines.
+        
+        That is the snapshot(), followed by the top allocation sites if
+        tracemalloc is tracing, or else the commonest types of object.
+        """
+        snapshot = self.snapshot()
+        lines = ["memory usage %(usage)d bytes; %(connections)d connections "
+                 "(%(closed_connections)d closed), %(active_requests)d "
+                 "active requests, %(buffered_bytes)d bytes buffered"
+                 % snapshot]
+        mounts = snapshot["mounts"].items()
+        mounts.sort()
+        for mount_point, stats in mounts:
+            lines.append("mount %r: %d bytes over %d sampled requests"
+                         % (mount_point or "/", stats["growth"],
+                            stats["samples"]))
+        if snapshot["tracing"]:
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+            for stat in stats[:limit]:
+                lines.append(str(stat))
+        else:
+            counts = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                counts[name] = counts.get(name, 0) + 1
+            counts = [(n, name) for name, n in counts.iteritems()]
+            for n, name in heapq.nlargest(limit, counts):
+                lines.append("%8d %s" % (n, name))
+        return lines
+
+
+class StatsApp(object):
+    """A WSGI app which reports server.stats() as JSON.
+    
+    Mount it with CherryPyWSGIServer(stats_path=...) or
+    server.add_mount(path, StatsApp(server)).
+    """
+    
+    def __init__(self, server):
+        self.server = server
+    
+    def __call__(self, environ, start_response):
+        from shotlib.json import dumps
+        body = dumps(self.server.stats())
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Cache-Control", "no-cache")])
+        return [body]
+
+
+class MountTable(object):
+    """The WSGI applications served by a server, by mount point.
+    
+    A mount point matches a path if it equals the path or the path starts
+    with the mount point plus "/"; match() returns the longest matching
+    mount point. Mount points are kept in a tree keyed by path segment, so
+    a match costs one dict lookup per segment of the path, however many
+    applications are mounted.
+    
+    add() and remove() may be called at any time: they build a new tree
+    and swap it in, so match() never needs a lock.
+    """
+    
+    def __init__(self, mount_points=()):
+        self._lock = threading.Lock()
+        self._apps = dict(mount_points)
+        self._rebuild()
+    
+    def _rebuild(self):
+        # Each node is [(mount_point, wsgi_app) or None, {segment: node}].
+        root = [None, {}]
+        for mount_point, wsgi_app in self._apps.iteritems():
+            node = root
+            for segment in mount_point.split("/")[1:]:
+                node = node[1].setdefault(segment, [None, {}])
+            node[0] = (mount_point, wsgi_app)
+        self._root = root
+        self._sorted = sorted(self._apps.iteritems(), reverse=True)
+    
+    def add(self, mount_point, wsgi_app):
+        """Mount (or re-mount) the given WSGI app at mount_point."""
+        self._lock.acquire()
+        try:
+            self._apps[mount_point] = wsgi_app
+            self._rebuild()
+        finally:
+            self._lock.release()
+    
+    def remove(self, mount_point):
+        """Unmount the app at mount_point. Raises KeyError if none."""
+        self._lock.acquire()
+        try:
+            del self._apps[mount_point]
+            self._rebuild()
+        finally:
+            self._lock.release()
+    
+    def items(self):
+        """Return a list of (mount_point, wsgi_app), longest first."""
+        return list(self._sorted)
+    
+    def shortest(self):
+        """Return the (mount_point, wsgi_app) pair which sorts last."""
+        mounts = self._sorted
+        if mounts:
+            return mounts[-1]
+        return None
+    
+    def match(self, path):
+        """Return the (mount_point, wsgi_app) pair for path, or None."""
+        node = self._root
+        found = node[0]
+        if path[:1] not in ("", "/"):
+            return None
+        start = 1
+        end = len(path)
+        while node[1] and start <= end:
+            stop = path.find("/", start)
+            if stop < 0:
+                stop = end
+            node = node[1].get(path[start:stop])
+            if node is None:
+                break
+            if node[0] is not None:
+                found = node[0]
+            start = stop + 1
+        return found
+
+
+class CompressionCache(object):
+    """LRU cache of compressed response bodies, for HTTPRequest.encode_body.
+    
+    Entries are keyed by content-coding, ETag and URI; the least recently
+    used are dropped once they add up to more than max_bytes.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key):
+        """Return the body cached for key, or None."""
+        self._lock.acquire()
+        try:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+        finally:
+            self._lock.release()
+    
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                key, old = self._items.popitem(last=False)
+                self.size -= len(old)
+        finally:
+            self._lock.release()
+
+
 class CherryPyWSGIServer(object):
     """An HTTP server for WSGI.
     
     bind_addr: a (host, port) tuple if TCP sockets are desired;
         for UNIX sockets, supply the filename as a string.
     wsgi_app: the WSGI 'application callable'; multiple WSGI applications
-        may be passed as (script_name, callable) pairs.
+        may be passed as (script_name, callable) pairs. Apps can also be
+        mounted and unmounted while running with add_mount/remove_mount.
     numthreads: the number of worker threads to create (default 10).
+    min_threads: the number of worker threads to keep running, even when
+        idle (defaults to numthreads).
+    max_threads: the most worker threads to run under load (defaults to
+        min_threads, i.e. a fixed size pool). See ThreadPool.
     server_name: the string to set for WSGI's SERVER_NAME environ entry.
         Defaults to socket.gethostname().
     max: the maximum number of queued requests (defaults to -1 = no limit).
+        Connections arriving while the queue is full get a "503 Service
+        Unavailable" instead of stalling the accept loop.
     request_queue_size: the 'backlog' argument to socket.listen();
         specifies the maximum number of queued connections (default 5).
     timeout: the timeout in seconds for accepted connections (default 10).
+    use_selector: if True, new and idle keep-alive connections are watched
+        by a ConnectionSelector (epoll) instead of each holding a worker
+        thread, and only connections with a complete request head are
+        queued for the workers (default False). Not used with SSL.
+    
+    keepalive_timeout: with use_selector, the number of seconds an idle
+        connection is kept open waiting for its next request (default 300).
+    max_request_header_size: the largest request head (Request-Line plus
+        headers) accepted, in bytes (default 64k). Longer heads get a
+        "400 Bad Request".
+    max_request_body_size: the largest request body accepted, in bytes
+        (default 0 = no limit). Larger bodies get a "413 Request Entity
+        Too Large" (as soon as the Content-Length is seen, or while a
+        chunked body is being read).
+    drain_request_body_size: after responding, up to this many unread
+        request body bytes are read and discarded to keep the connection
+        alive (default 64k); if more remain, the connection is closed.
+    
+    max_connections: the most connections (active, queued and idle) kept
+        open at once (default 0 = no limit). When a new connection would
+        exceed it, the longest idle keep-alive connections are closed to
+        make room (with use_selector); failing that the new connection gets
+        a "503 Service Unavailable".
+    max_queue_wait: connections which waited in the queue for longer than
+        this many seconds get a 503 instead of being served (default 0 =
+        no limit).
+    retry_after: the Retry-After value, in seconds, sent with those 503
+        responses (default 1).
+    
+    compress: if True, responses are gzip (or deflate) compressed for
+        clients which accept it (default False). Bodies returned as a
+        single string are compressed in one go and sent with a
+        Content-Length; anything else is compressed chunk by chunk as the
+        app produces it. Responses already carrying a Content-Encoding,
+        with "Cache-Control: no-transform", or to HEAD requests are left
+        alone; to keep a streamed response from being buffered by zlib,
+        send "Content-Encoding: identity".
+    compress_level: the zlib compression level, 1-9 (default 6).
+    compress_min_size: bodies known to be shorter than this many bytes
+        are not compressed (default 1024).
+    compress_types: Content-Type prefixes of responses to compress
+        (default text/*, JSON, JavaScript, XML and SVG).
+    compress_cache_size: if non-zero, compressed bodies of responses with
+        a strong ETag are kept in a CompressionCache of up to this many
+        bytes, so repeated responses are only compressed once (default 0).
+    
+    stats_collector: an object to record per-request timings and
+        counters, such as a ServerStats instance (default None: no
+        statistics beyond thread and queue counts). See stats().
+    stats_path: if given, a StatsApp reporting stats() as JSON is mounted
+        at this path.
+    memory_collector: a MemoryStats instance, to count live connections,
+        requests and buffered bytes and watch for leaks (default None).
+    
+    accept_batch: the most connections accepted each time the listening
+        socket is readable (default 64).
+    nodelay: set TCP_NODELAY on TCP connections (default True).
+    defer_accept: if non-zero, set TCP_DEFER_ACCEPT on the listening socket
+        (Linux), so connections are only accepted once the client has
+        sent data or this many seconds have passed (default 0).
+    multiprocess: set True if other processes serve the same socket;
+        sets wsgi.multiprocess in the environ (default False).
+    reuse_port: set SO_REUSEPORT on the socket, so that several processes
+        can each bind their own socket to the same address and have the
+        kernel balance connections between them (default False).
     
     protocol: the version string to write in the Status-Line of all
         HTTP responses. For example, "HTTP/1.1" (the default). This
@@ -760,36 +2788,128 @@ class CherryPyWSGIServer(object):
     ready = False
     _interrupt = None
     ConnectionClass = HTTPConnection
+    SelectorClass = ConnectionSelector
+    socket = None
+    selector = None
+    _waker = None
+    _server_line = None
+    accept_batch = 64
+    nodelay = True
+    defer_accept = 0
+    stats_collector = None
+    memory_collector = None
+    multiprocess = False
+    reuse_port = False
+    keepalive_timeout = 300
+    max_request_header_size = 65536
+    max_request_body_size = 0
+    drain_request_body_size = 65536
+    max_connections = 0
+    max_queue_wait = 0
+    retry_after = 1
+    compress = False
+    compress_level = 6
+    compress_min_size = 1024
+    compress_types = ("text/", "application/json", "application/javascript",
+                      "application/xml", "image/svg+xml")
+    compress_cache_size = 0
+    compress_cache = None
     
     # Paths to certificate and private key files
     ssl_certificate = None
     ssl_private_key = None
     
     def __init__(self, bind_addr, wsgi_app, numthreads=10, server_name=None,
-                 max=-1, request_queue_size=5, timeout=10):
-        self.requests = Queue.Queue(max)
+                 max=-1, request_queue_size=5, timeout=10,
+                 use_selector=False, min_threads=None, max_threads=None,
+                 stats_collector=None, stats_path=None,
+                 memory_collector=None):
         
         if callable(wsgi_app):
             # We've been handed a single wsgi_app, in CP-2.1 style.
             # Assume it's mounted at "".
-            self.mount_points = [("", wsgi_app)]
+            self.mounts = MountTable([("", wsgi_app)])
         else:
             # We've been handed a list of (mount_point, wsgi_app) tuples,
             # so that the server can call different wsgi_apps, and also
             # correctly set SCRIPT_NAME.
-            self.mount_points = wsgi_app
-        self.mount_points.sort()
-        self.mount_points.reverse()
+            self.mounts = MountTable(wsgi_app)
         
         self.bind_addr = bind_addr
+        self._open = 0
+        self._open_lock = threading.Lock()
         self.numthreads = numthreads or 1
+        min_threads = min_threads or self.numthreads
+        if not max_threads or max_threads < min_threads:
+            max_threads = min_threads
+        self.requests = ThreadPool(self, min=min_threads, max=max_threads,
+                                   maxsize=max)
         if not server_name:
             server_name = socket.gethostname()
         self.server_name = server_name
         self.request_queue_size = request_queue_size
-        self._workerThreads = []
         
         self.timeout = timeout
+        self.use_selector = use_selector
+        self.stats_collector = stats_collector
+        self.memory_collector = memory_collector
+        if stats_path is not None:
+            self.add_mount(stats_path, StatsApp(self))
+    
+    def _get_mount_points(self):
+        return self.mounts.items()
+    mount_points = property(_get_mount_points,
+                            doc="A list of (mount_point, wsgi_app) pairs, "
+                                "sorted by mount_point, descending.")
+    
+    def add_mount(self, mount_point, wsgi_app):
+        """Serve wsgi_app at mount_point; safe while the server is running."""
+        self.mounts.add(mount_point, wsgi_app)
+    
+    def remove_mount(self, mount_point):
+        """Stop serving the app at mount_point; safe while running."""
+        self.mounts.remove(mount_point)
+    
+    def _get_open_connections(self):
+        return self._open
+    open_connections = property(_get_open_connections,
+                                doc="The number of connections now open.")
+    
+    def _count_connection(self, delta):
+        self._open_lock.acquire()
+        try:
+            self._open += delta
+        finally:
+            self._open_lock.release()
+    
+    def server_line(self):
+        """Return the "Server: <version>" response header line (with CRLF)."""
+        line = self._server_line
+        if line is None or line[0] != self.version:
+            line = self._server_line = (self.version,
+                                        "Server: %s\r\n" % self.version)
+        return line[1]
+    
+    def stats(self):
+        """Return a dict snapshot of the server's current statistics.
+        
+        Thread and queue figures are always present; request counts and
+        latency histograms are merged in from stats_collector, if set.
+        """
+        pool = self.requests
+        snapshot = {"threads": pool.size,
+                    "idle_threads": pool.idle,
+                    "queued": pool.qsize(),
+                    "open_connections": self._open,
+                    }
+        selector = self.selector
+        if selector is not None:
+            snapshot["idle_connections"] = len(selector)
+        if self.stats_collector is not None:
+            snapshot.update(self.stats_collector.snapshot())
+        if self.memory_collector is not None:
+            snapshot["memory"] = self.memory_collector.snapshot()
+        return snapshot
     
     def start(self):
         """Run the server forever."""
@@ -799,6 +2919,52 @@ class CherryPyWSGIServer(object):
         # trap those exceptions in whatever code block calls start().
         self._interrupt = None
         
+        if self.socket is None:
+            self.listen()
+        
+        if self.compress_cache_size and self.compress_cache is None:
+            self.compress_cache = CompressionCache(self.compress_cache_size)
+        
+        if not isinstance(self.socket, SSLConnection):
+            # Wait for readiness (with no timeout poll) and then accept
+            # everything pending; stop() wakes us via the WakeupPipe.
+            if self.use_selector:
+                self.selector = self.SelectorClass(self)
+                self.selector.add_listener(self.socket)
+            else:
+                self.socket.setblocking(0)
+                self._waker = WakeupPipe()
+        
+        # Create worker threads
+        self.requests.start()
+        
+        self.ready = True
+        try:
+            while self.ready:
+                self.tick()
+                self.requests.maintain()
+                if self.memory_collector is not None:
+                    self.memory_collector.maintain()
+                if self.interrupt:
+                    while self.interrupt is True:
+                        # Wait for self.stop() to complete. See _set_interrupt.
+                        time.sleep(0.1)
+                    raise self.interrupt
+        finally:
+            if self.selector is not None:
+                self.selector.close()
+                self.selector = None
+            if self._waker is not None:
+                self._waker.close()
+                self._waker = None
+    
+    def listen(self):
+        """Create, bind and listen on the server socket.
+        
+        start() calls this if the socket does not exist yet. Call it
+        before start() to open the socket early, e.g. in a parent process
+        which then forks several processes serving it.
+        """
         # Select the appropriate socket
         if isinstance(self.bind_addr, basestring):
             # AF_UNIX socket
@@ -853,31 +3019,25 @@ class CherryPyWSGIServer(object):
         # Timeout so KeyboardInterrupt can be caught on Win32
         self.socket.settimeout(1)
         self.socket.listen(self.request_queue_size)
-        
-        # Create worker threads
-        for i in xrange(self.numthreads):
-            self._workerThreads.append(WorkerThread(self))
-        for worker in self._workerThreads:
-            worker.setName("CP WSGIServer " + worker.getName())
-            worker.start()
-        for worker in self._workerThreads:
-            while not worker.ready:
-                time.sleep(.1)
-        
-        self.ready = True
-        while self.ready:
-            self.tick()
-            if self.interrupt:
-                while self.interrupt is True:
-                    # Wait for self.stop() to complete. See _set_interrupt.
-                    time.sleep(0.1)
-                raise self.interrupt
     
     def bind(self, family, type, proto=0):
         """Create (or recreate) the actual socket object."""
         self.socket = socket.socket(family, type, proto)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-##        self.socket.setsockopt(socket.SOL_SOCKET, socket.TCP_NODELAY, 1)
+        if family in (socket.AF_INET, socket.AF_INET6):
+            if self.nodelay:
+                # Linux passes this on to accepted sockets; accept() sets
+                # it again for platforms which don't.
+                self.socket.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+            if self.defer_accept and hasattr(socket, "TCP_DEFER_ACCEPT"):
+                self.socket.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_DEFER_ACCEPT,
+                                       self.defer_accept)
+        if self.reuse_port:
+            if SO_REUSEPORT is None:
+                raise socket.error("SO_REUSEPORT is not supported here.")
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         if self.ssl_certificate and self.ssl_private_key:
             if SSL is None:
                 raise ImportError("You must install pyOpenSSL to use HTTPS.")
@@ -891,28 +3051,153 @@ class CherryPyWSGIServer(object):
         self.socket.bind(self.bind_addr)
     
     def tick(self):
-        """Accept a new connection and put it on the Queue."""
+        """Accept new connections and put them on the Queue."""
+        if self.selector is not None:
+            # The selector accepts, and queues connections once their
+            # request head has arrived.
+            self.selector.poll(self.tick_timeout())
+            return
+        
+        waker = self._waker
+        if waker is None:
+            # SSL: a blocking accept() with a 1 second timeout.
+            conn = self.accept()
+            if conn is not None:
+                for conn in self.admit([conn]):
+                    self.requests.put(conn)
+            return
+        
+        sock = self.socket
+        if sock is None:
+            # stop() got here first.
+            return
         try:
-            s, addr = self.socket.accept()
+            r, w, x = select.select([sock, waker], [], [],
+                                    self.tick_timeout())
+        except (select.error, socket.error, ValueError), e:
+            # EINTR, or the socket was closed by stop().
+            return
+        if waker in r:
+            waker.drain()
+        # (stop() may have woken us, from another thread, after closing
+        # the socket.)
+        if r and self.ready and self.socket is not None:
+            conns = self.accept_many()
+            if conns:
+                self.requests.put_many(conns)
+    
+    def tick_timeout(self):
+        """Return the seconds tick() may wait for a connection (None = ever).
+        
+        tick() only needs to come back early when the ThreadPool or the
+        ConnectionSelector (or the MemoryStats watchdog) have housekeeping
+        to do.
+        """
+        timeout = self.requests.maintain_timeout()
+        selector = self.selector
+        if selector is not None and len(selector):
+            if timeout is None or selector.sweep_interval < timeout:
+                timeout = selector.sweep_interval
+        memory = self.memory_collector
+        if memory is not None:
+            if timeout is None or memory.check_interval < timeout:
+                timeout = memory.check_interval
+        return timeout
+    
+    def accept_many(self):
+        """Accept up to accept_batch pending connections and return them."""
+        conns = []
+        for i in xrange(self.accept_batch):
+            conn = self.accept()
+            if conn is None:
+                break
+            conns.append(conn)
+        if conns and self.max_connections:
+            conns = self.admit(conns)
+        return conns
+    
+    def admit(self, conns):
+        """Return those of the newly accepted conns there is room for.
+        
+        Idle keep-alive connections are evicted to make room for new ones
+        where possible; the rest of the (newest) conns are rejected.
+        """
+        if not self.max_connections:
+            return conns
+        excess = self._open - self.max_connections
+        if excess > 0 and self.selector is not None:
+            excess -= self.selector.evict(excess)
+        if excess <= 0:
+            return conns
+        keep = max(len(conns) - excess, 0)
+        for conn in conns[keep:]:
+            self.reject(conn)
+        return conns[:keep]
+    
+    def reject(self, conn):
+        """Answer conn with a "503 Service Unavailable" and close it.
+        
+        The request is not read, and the 503 is sent without blocking (if
+        it doesn't fit in the socket buffer, the client just sees the
+        connection close), so overload costs as little as possible.
+        """
+        if self.stats_collector is not None:
+            self.stats_collector.rejected()
+        if not (SSL and isinstance(conn.socket, SSL.ConnectionType)):
+            try:
+                conn.socket.setblocking(0)
+                conn.socket.send(self.busy_response())
+            except socket.error:
+                pass
+        conn.close()
+    
+    def busy_response(self):
+        """Return the complete "503 Service Unavailable" reject() sends."""
+        return "".join([status_line(self.protocol, "503 Service Unavailable"),
+                        "Retry-After: %d\r\n" % self.retry_after,
+                        "Content-Length: 0\r\n",
+                        "Connection: close\r\n",
+                        "Date: ", http_date(), "\r\n",
+                        self.server_line(),
+                        "\r\n"])
+    
+    def accept(self):
+        """Accept a new connection and return a ConnectionClass for it.
+        
+        Returns None if there was nothing to accept (or no socket left to
+        accept on).
+        """
+        sock = self.socket
+        if sock is None:
+            return None
+        try:
+            s, addr = sock.accept()
             if not self.ready:
-                return
+                return None
             if hasattr(s, 'settimeout'):
                 s.settimeout(self.timeout)
-            conn = self.ConnectionClass(s, addr, self)
-            self.requests.put(conn)
+            if self.nodelay and not isinstance(self.bind_addr, basestring):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.stats_collector is not None:
+                self.stats_collector.opened()
+            return self.ConnectionClass(s, addr, self)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
             # notice keyboard interrupts on Win32, which don't interrupt
             # accept() by default
-            return
+            return None
         except socket.error, x:
+            if x.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                             errno.ECONNABORTED):
+                # Nothing (left) to accept, or the client already gave up.
+                return None
             msg = x.args[1]
             if msg in ("Bad file descriptor", "Socket operation on non-socket"):
                 # Our socket was closed.
-                return
+                return None
             if msg == "Resource temporarily unavailable":
                 # Just try again. See http://www.cherrypy.org/ticket/479.
-                return
+                return None
             raise
     
     def _get_interrupt(self):
@@ -931,8 +3216,12 @@ class CherryPyWSGIServer(object):
         
         sock = getattr(self, "socket", None)
         if sock:
-            if not isinstance(self.bind_addr, basestring):
+            if (not isinstance(self.bind_addr, basestring) and
+                    self.selector is None and self._waker is None):
                 # Touch our own socket to make accept() return immediately.
+                # Only the blocking (SSL) accept needs this; the others are
+                # woken below (and after a handoff, another process would
+                # be the one to accept it).
                 try:
                     host, port = sock.getsockname()[:2]
                 except socket.error, x:
@@ -961,20 +3250,14 @@ class CherryPyWSGIServer(object):
                 sock.close()
             self.socket = None
         
-        # Must shut down threads here so the code that calls
-        # this method can know when all threads are stopped.
-        for worker in self._workerThreads:
-            self.requests.put(_SHUTDOWNREQUEST)
+        selector = self.selector
+        if selector is not None:
+            selector.wakeup()
+        waker = self._waker
+        if waker is not None:
+            waker.wakeup()
         
-        # Don't join currentThread (when stop is called inside a request).
-        current = threading.currentThread()
-        while self._workerThreads:
-            worker = self._workerThreads.pop()
-            if worker is not current and worker.isAlive:
-                try:
-                    worker.join()
-                except AssertionError:
-                    pass
+        self.requests.stop()
     
     def populate_ssl_environ(self):
         """Create WSGI environ entries to be merged into each request."""